@@ -1,11 +1,33 @@
+import os
 import pygame
 import random
-
-from typing import Callable
+import argparse
+import asyncio
+import time
+import socket
+import sys
+import json
+import queue
+import threading
+import struct
+import itertools
+import gc
+import types
+import weakref
+import tracemalloc
+import logging
+import math
+import bisect
+
+from array import array
+from collections import deque, Counter
+from typing import Callable, Coroutine
 from pygame import Vector2, Rect, Color, Surface
 
 
 pygame.init()
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+logger = logging.getLogger("game")
 
 
 
@@ -125,18 +147,171 @@ Buffs = [
 ]
 
 
+# 画质等级, 从上到下逐级降低
+QualityLevels = [
+    {"name": "high", "lable_refresh_interval": 0, "enemy_health_bar": True, "max_bullet_count": 0, "enemy_spawn_interval": 0, "particle_burst_scale": 1.0},
+    {"name": "medium", "lable_refresh_interval": 250, "enemy_health_bar": True, "max_bullet_count": 0, "enemy_spawn_interval": 0, "particle_burst_scale": 1.0},
+    {"name": "low", "lable_refresh_interval": 250, "enemy_health_bar": False, "max_bullet_count": 0, "enemy_spawn_interval": 0, "particle_burst_scale": 0.5},
+    {"name": "lower", "lable_refresh_interval": 500, "enemy_health_bar": False, "max_bullet_count": 200, "enemy_spawn_interval": 0, "particle_burst_scale": 0.5},
+    {"name": "lowest", "lable_refresh_interval": 500, "enemy_health_bar": False, "max_bullet_count": 100, "enemy_spawn_interval": 500, "particle_burst_scale": 0.25},
+]
+
+
+class FrameGovernor:
+
+    def __init__(self, target_fps: int = 120, window: int = 60):
+        self.target_fps = target_fps
+        self.frame_times = deque(maxlen=window)
+        self.degrade_threshold = 1.0
+        self.upgrade_threshold = 0.6
+        # 降级看中位数, 单帧尖峰不会触发; 升级看 90 分位并且要等更久, 避免在两档之间来回切换
+        self.degrade_percentile = 0.5
+        self.upgrade_percentile = 0.9
+        self.degrade_cooldown = 1000
+        self.upgrade_cooldown = 3000
+        self.level = 0
+        self.quality = QualityLevels[self.level]
+
+        self.__last_change_time = 0
+
+
+    def get_budget(self) -> float:
+        return 1000.0 / self.target_fps
+
+
+    def get_average(self) -> float:
+        if len(self.frame_times) == 0:
+            return 0.0
+        return sum(self.frame_times) / len(self.frame_times)
+
+
+    def get_percentile(self, percentile: float) -> float:
+        if len(self.frame_times) == 0:
+            return 0.0
+        frame_times = sorted(self.frame_times)
+        index = min(int(len(frame_times) * percentile), len(frame_times) - 1)
+        return frame_times[index]
+
+
+    def record(self, frame_time: float) -> None:
+        self.frame_times.append(frame_time)
+        if len(self.frame_times) < self.frame_times.maxlen:
+            return
+
+        elapsed = pygame.time.get_ticks() - self.__last_change_time
+        budget = self.get_budget()
+        if self.level < len(QualityLevels) - 1 and elapsed >= self.degrade_cooldown:
+            if self.get_percentile(self.degrade_percentile) > budget * self.degrade_threshold:
+                self.set_level(self.level + 1)
+                return
+        if self.level > 0 and elapsed >= self.upgrade_cooldown:
+            if self.get_percentile(self.upgrade_percentile) < budget * self.upgrade_threshold:
+                self.set_level(self.level - 1)
+
+
+    def set_level(self, level: int) -> None:
+        level = pygame.math.clamp(level, 0, len(QualityLevels) - 1)
+        if level == self.level:
+            return
+        logger.info("quality level %s -> %s (median frame %.2fms, p90 %.2fms, budget %.2fms)",
+                    self.quality["name"], QualityLevels[level]["name"],
+                    self.get_percentile(0.5), self.get_percentile(0.9), self.get_budget())
+        self.level = level
+        self.quality = QualityLevels[level]
+        self.frame_times.clear()
+        self.__last_change_time = pygame.time.get_ticks()
+
+
+class InputDispatcher:
+
+    def __init__(self, root: "Root"):
+        self.root = root
+        self.key_handlers = {}
+        self.buttons = []
+
+
+    def bind_key(self, key: int, handler: Callable) -> None:
+        handlers = self.key_handlers.get(key)
+        if handlers is None:
+            handlers = []
+            self.key_handlers[key] = handlers
+        handlers.append(handler)
+
+
+    def unbind_key(self, key: int, handler: Callable) -> None:
+        handlers = self.key_handlers.get(key)
+        if handlers is None or handler not in handlers:
+            return
+        handlers.remove(handler)
+
+
+    def add_button(self, button: "Button") -> None:
+        # buttons 始终按 z_index 从高到低排列, 只在增删按钮或按钮的 z_index 变化时调整
+        if button not in self.buttons:
+            bisect.insort(self.buttons, button, key=lambda btn: -btn.z_index)
+
+
+    def remove_button(self, button: "Button") -> None:
+        if button in self.buttons:
+            self.buttons.remove(button)
+
+
+    def update_button(self, button: "Button") -> None:
+        if button not in self.buttons:
+            return
+        self.buttons.remove(button)
+        bisect.insort(self.buttons, button, key=lambda btn: -btn.z_index)
+
+
+    def hit_test(self, pos: Vector2) -> "Button":
+        # 只在点击时检查, 第一个命中的可见按钮就是最上层的
+        for btn in self.buttons:
+            if btn.is_active() and btn.get_rect().collidepoint(pos):
+                return btn
+        return None
+
+
+    def process(self, events: list) -> None:
+        for event in events:
+            if event.type == pygame.MOUSEMOTION:
+                self.root.mouse_pos = Vector2(event.pos)
+            elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+                self.root.mouse_pos = Vector2(event.pos)
+                btn = self.hit_test(event.pos)
+                if btn is not None:
+                    btn.pressed_singal.emit()
+            elif event.type == pygame.KEYDOWN:
+                for handler in self.key_handlers.get(event.key, [])[:]:
+                    handler()
+
+
+
 class Node2D:
 
+    instances = weakref.WeakSet()
+    id_counter = itertools.count(1)
+
     def __init__(self, parent: "Node2D", pos: Vector2, size: Vector2, z_index: int = 0):
+        Node2D.instances.add(self)
+        self.net_id = next(Node2D.id_counter)
         self.parent = parent
-        self.pos = pos
+        self.local_pos = None
+        self.followers = []
+        self.__pos = Vector2(pos)
+        self.__pos_dirty = False
         self.size = size
         self.collision_rect = Rect(pos, size)
         self.z_index = z_index
         self.visible = True
         self.can_paused = True
+        # 暂停期间自身画面不变的不可暂停节点 (例如半透明遮罩), 暂停时只烘焙进背景一次, 仍然每帧 update
+        self.static_in_pause = False
         self.children = []
+        self.__child_indices = {}
+        self.group_names = []
+        self.is_removed = False
         self.can_collide = False
+        self.is_ui = False
         self.has_collided_signal = Signal()
 
         self.set_parent(parent)
@@ -149,37 +324,161 @@ class Node2D:
     def draw(self, surface: Surface) -> None:
         if not self.visible: return
 
+
+    def get_render_scale(self, surface: Surface) -> float:
+        # 节点始终使用逻辑坐标, 绘制时按目标画布相对逻辑分辨率的比例缩放
+        return surface.get_width() / Root.instance.size.x
+
+
+    @property
+    def pos(self) -> Vector2:
+        if self.__pos_dirty:
+            parent_pos = self.parent.pos
+            self.__pos.x = parent_pos.x + self.local_pos.x
+            self.__pos.y = parent_pos.y + self.local_pos.y
+            self.__pos_dirty = False
+        return self.__pos
+
+
+    @pos.setter
+    def pos(self, value: Vector2) -> None:
+        # 只有通过赋值修改位置才会通知跟随的子节点, 直接修改 pos.x / pos.y 不会
+        if self.local_pos is not None and self.parent is not None:
+            parent_pos = self.parent.pos
+            self.local_pos.x = value[0] - parent_pos.x
+            self.local_pos.y = value[1] - parent_pos.y
+        self.__pos.update(value)
+        self.__pos_dirty = False
+        self._mark_followers_dirty()
+
+
+    def _mark_followers_dirty(self) -> None:
+        for follower in self.followers:
+            if not follower.__pos_dirty:
+                follower.__pos_dirty = True
+                follower._mark_followers_dirty()
+
+
+    def set_local_pos(self, local_pos: Vector2) -> None:
+        # 设置相对父节点的偏移后, 世界坐标随父节点移动自动更新; 传入 None 则恢复为独立坐标
+        if local_pos is None:
+            self.__pos.update(self.pos)
+            self.local_pos = None
+            if self.parent is not None and self in self.parent.followers:
+                self.parent.followers.remove(self)
+            return
+
+        self.local_pos = Vector2(local_pos)
+        if self.parent is None:
+            return
+        if self not in self.parent.followers:
+            self.parent.followers.append(self)
+        self.__pos_dirty = True
+        self._mark_followers_dirty()
+
+
     def set_parent(self, parent: "Node2D") -> None:
+        old_parent = self.parent
+        if old_parent is not None:
+            # 先按旧父节点算出缓存的位置, 否则断开后再读 pos 就找不到父节点了
+            if self.__pos_dirty:
+                self.pos
+            if old_parent is not parent:
+                old_parent._detach_child(self)
+            if self in old_parent.followers:
+                old_parent.followers.remove(self)
         self.parent = parent
         if parent is None:
             return
-        if not self in parent.children:
-            parent.children.append(self)
+        if parent.is_ui:
+            self.is_ui = True
+        if self.local_pos is not None:
+            parent.followers.append(self)
+            self.__pos_dirty = True
+            self._mark_followers_dirty()
+        parent._attach_child(self)
+
+
+    def _attach_child(self, child: "Node2D") -> None:
+        # 记录每个子节点在 children 中的下标, 移除时与最后一个交换, 都是 O(1)
+        if child in self.__child_indices:
+            return
+        self.__child_indices[child] = len(self.children)
+        self.children.append(child)
+
+
+    def _detach_child(self, child: "Node2D") -> None:
+        index = self.__child_indices.pop(child, None)
+        if index is None:
+            return
+        last = self.children.pop()
+        if last is not child:
+            self.children[index] = last
+            self.__child_indices[last] = index
 
     
     def add_child(self, child: "Node2D") -> None:
-        self.children.append(child)
         child.set_parent(self)
 
 
+    def add_children(self, children: list) -> None:
+        # 批量添加新节点, 调用方需保证这些节点还没有父节点
+        for child in children:
+            child.parent = self
+            if child.local_pos is not None:
+                child.set_local_pos(child.local_pos)
+            self.__child_indices[child] = len(self.children)
+            self.children.append(child)
+
+
     def remove_child(self, child: "Node2D") -> None:
-        if child not in self.children:
+        # 立即移除; 在帧中间销毁节点请使用 remove
+        if child not in self.__child_indices:
             return
-        self.children.remove(child)
         child.set_parent(None)
 
 
     def remove_all_children(self) -> None:
-        for child in self.children[:]:
-            self.children.remove(child)
-            child.set_parent(None)
+        for child in self.children:
+            child.remove()
 
     
     def remove(self) -> None:
-        if self.parent is None:
+        # 标记为已移除并放入 Root 的队列, 在帧末统一从树上摘下; 之后本帧内不再更新、绘制或参与碰撞
+        if self.parent is None or self.is_removed:
             return
-        self.parent.remove_child(self)
-        self.parent = None
+        self._mark_removed()
+        Root.instance.removal_queue.append(self)
+
+
+    def _mark_removed(self) -> None:
+        self.is_removed = True
+        for child in self.children:
+            child._mark_removed()
+
+
+    def _release(self) -> None:
+        # 断开信号、分组和子节点的引用, 让整棵子树可以被立即回收
+        self.is_removed = True
+        self.has_collided_signal.disconnect_all()
+        root = Root.instance
+        for name in self.group_names:
+            group = root.groups.get(name)
+            if group is not None and self in group:
+                group.remove(self)
+                if len(group) == 0:
+                    del root.groups[name]
+        self.group_names.clear()
+
+        children = self.children
+        self.children = []
+        self.__child_indices = {}
+        self.followers.clear()
+        for child in children:
+            if child.__pos_dirty:
+                child.pos
+            child.parent = None
+            child._release()
 
 
     def get_all_children(self) -> list:
@@ -212,6 +511,101 @@ class Node2D:
             group = []
             root.groups[name] = group
         group.append(self)
+        self.group_names.append(name)
+
+
+
+class MemoryTracker:
+
+    def __init__(self, root: "Root", window: int = 600):
+        self.root = root
+        self.frame_alloc_deltas = deque(maxlen=window)
+        self.top_count = 10
+
+        self.__last_traced = 0
+        self.__last_snapshot = None
+
+
+    def start_tracing(self) -> None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.__last_traced = tracemalloc.get_traced_memory()[0]
+        self.__last_snapshot = tracemalloc.take_snapshot()
+
+
+    def record_frame(self) -> None:
+        if not tracemalloc.is_tracing():
+            return
+        current = tracemalloc.get_traced_memory()[0]
+        self.frame_alloc_deltas.append(current - self.__last_traced)
+        self.__last_traced = current
+
+
+    def get_live_counts(self) -> Counter:
+        return Counter(type(node).__name__ for node in Node2D.instances)
+
+
+    def get_orphans(self) -> list:
+        # 不在 Root 树上但仍被引用的节点, 先回收循环引用避免误报
+        gc.collect()
+        reachable = set(id(node) for node in self.root.get_all_children())
+        reachable.add(id(self.root))
+        return [node for node in Node2D.instances if id(node) not in reachable]
+
+
+    def _describe_referrers(self, node: Node2D, ignore: list) -> str:
+        names = []
+        for referrer in gc.get_referrers(node):
+            if referrer is ignore or isinstance(referrer, types.FrameType):
+                continue
+            if isinstance(referrer, (list, dict)) and referrer is not node.__dict__:
+                owner = next((o for o in gc.get_referrers(referrer) if isinstance(o, Node2D)), None)
+                if owner is not None:
+                    names.append(f"{type(referrer).__name__} of {type(owner).__name__}")
+                    continue
+            names.append(type(referrer).__name__)
+        return ", ".join(names)
+
+
+    def report(self) -> str:
+        orphans = self.get_orphans()
+        reachable = Counter(type(node).__name__ for node in self.root.get_all_children())
+        live = self.get_live_counts()
+        orphan_counts = Counter(type(node).__name__ for node in orphans)
+
+        lines = ["memory report:", "  live nodes by class (live / in tree / orphaned):"]
+        for name, count in live.most_common():
+            lines.append(f"    {name}: {count} / {reachable.get(name, 0)} / {orphan_counts.get(name, 0)}")
+
+        lines.append("  groups: " + ", ".join(f"{name}={len(group)}" for name, group in self.root.groups.items()))
+
+        if len(orphans) > 0:
+            lines.append("  orphan samples:")
+            # 按下标取样, 切片生成的临时列表也会出现在引用者里
+            for i in range(min(len(orphans), self.top_count)):
+                node = orphans[i]
+                lines.append(f"    {type(node).__name__} referenced by: {self._describe_referrers(node, orphans)}")
+
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            lines.append(f"  traced memory: current {current / 1024:.1f}KiB, peak {peak / 1024:.1f}KiB")
+            if len(self.frame_alloc_deltas) > 0:
+                deltas = self.frame_alloc_deltas
+                lines.append(f"  per-frame delta over {len(deltas)} frames: avg {sum(deltas) / len(deltas):+.0f}B, max {max(deltas):+d}B, min {min(deltas):+d}B")
+            snapshot = tracemalloc.take_snapshot()
+            if self.__last_snapshot is not None:
+                lines.append("  top growth since last report:")
+                for stat in snapshot.compare_to(self.__last_snapshot, "lineno")[:self.top_count]:
+                    lines.append(f"    {stat}")
+            self.__last_snapshot = snapshot
+        else:
+            lines.append("  tracemalloc is off, run with --memory-report for allocation data")
+
+        return "\n".join(lines)
+
+
+    def dump(self) -> None:
+        logger.info(self.report())
 
 
 
@@ -230,7 +624,11 @@ class Root(Node2D):
         self.groups = {}
         self.delta = 0.0
         self.clear_color = Color(0, 0, 0)
-        self.mouse_pos = Vector2(0, 0)
+        # 之后只在鼠标事件中更新, 启动时先取一次当前位置
+        self.mouse_pos = Vector2(pygame.mouse.get_pos())
+        self.governor = FrameGovernor()
+        self.input = InputDispatcher(self)
+        self.removal_queue = []
 
         self.__pause_time = 0
         self.__pause_duration = 0
@@ -239,7 +637,16 @@ class Root(Node2D):
 
     def update(self, delta: float) -> None:
         self.delta = delta
-        self.mouse_pos = pygame.mouse.get_pos()
+
+
+    def flush_removals(self) -> None:
+        # 帧末统一处理本帧内 remove 的节点
+        removed = self.removal_queue
+        self.removal_queue = []
+        for node in removed:
+            if node.parent is not None:
+                node.parent.remove_child(node)
+            node._release()
 
 
     def get_nodes_in_group(self, name: str) -> list:
@@ -275,14 +682,38 @@ class Root(Node2D):
 
 class Sprite2D(Node2D):
 
+    # 缩放后的图像按原图缓存, 共享同一张图像的节点也共享缩放结果
+    scaled_images = weakref.WeakKeyDictionary()
+
     def __init__(self, parent: Node2D, pos: Vector2, image: Surface):
         super().__init__(parent, pos, Vector2(image.get_size()))
         self.image = image
         self.size = Vector2(image.get_size())
+        self.image_version = 0
     
     def draw(self, surface: Surface) -> None:
         super().draw(surface)
-        surface.blit(self.image, self.pos)
+        scale = self.get_render_scale(surface)
+        if scale == 1:
+            surface.blit(self.image, self.pos)
+        else:
+            surface.blit(self.get_scaled_image(scale), (self.pos.x * scale, self.pos.y * scale))
+
+    def mark_image_dirty(self) -> None:
+        # 修改 image 的内容后调用, 使缩放缓存失效
+        self.image_version += 1
+
+    def get_scaled_image(self, scale: float) -> Surface:
+        cached = Sprite2D.scaled_images.get(self.image)
+        if cached is not None and cached[0] == scale and cached[1] == self.image_version:
+            return cached[2]
+        width, height = self.image.get_size()
+        scaled = pygame.transform.scale(self.image, (max(1, round(width * scale)), max(1, round(height * scale))))
+        colorkey = self.image.get_colorkey()
+        if colorkey is not None:
+            scaled.set_colorkey(colorkey, pygame.RLEACCEL)
+        Sprite2D.scaled_images[self.image] = (scale, self.image_version, scaled)
+        return scaled
 
 
 class HealthBar(Sprite2D):
@@ -296,26 +727,208 @@ class HealthBar(Sprite2D):
         self.value_color = Color(255, 0, 0)
         self.z_index = 5
         self.image.set_colorkey((0, 0, 0))
+        self.__drawn_health = None
 
     def draw(self, surface: Surface) -> None:
-        self.image.fill((0, 0, 0))
-        pygame.draw.rect(self.image, self.border_color, (0, 0, self.size.x, self.size.y), self.border)
-        pygame.draw.rect(self.image, self.value_color, (self.border, self.border, (self.size.x - self.border * 2) * self.health * 1.0 / self.max_health, self.size.y - self.border * 2))
+        if self.__drawn_health != (self.health, self.max_health):
+            self.__drawn_health = (self.health, self.max_health)
+            self.image.fill((0, 0, 0))
+            pygame.draw.rect(self.image, self.border_color, (0, 0, self.size.x, self.size.y), self.border)
+            pygame.draw.rect(self.image, self.value_color, (self.border, self.border, (self.size.x - self.border * 2) * self.health * 1.0 / self.max_health, self.size.y - self.border * 2))
+            self.mark_image_dirty()
         super().draw(surface)
 
 
+# 默认场地中的障碍物, 以格子为单位 (x, y, w, h)
+DefaultObstacles = [
+    (4, 3, 5, 1), (4, 4, 1, 3),
+    (23, 3, 5, 1), (27, 4, 1, 3),
+    (4, 14, 5, 1), (4, 11, 1, 3),
+    (23, 14, 5, 1), (27, 11, 1, 3),
+    (15, 2, 2, 2), (15, 14, 2, 2),
+    (9, 8, 1, 2), (22, 8, 1, 2),
+]
+
+
+class TileMap(Sprite2D):
+
+    NEIGHBOURS = [(1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, 1), (-1, -1)]
+    TILE_SIZE = 40
+    TILE_COLOR = (90, 90, 100)
+    BORDER_COLOR = (130, 130, 140)
+    COLORKEY = (255, 0, 255)
+
+    def __init__(self, parent: Node2D, tile_size: int = TILE_SIZE, obstacles: list = DefaultObstacles):
+        size = pygame.display.get_surface().get_size()
+        super().__init__(parent, Vector2(0, 0), Surface(size))
+        self.z_index = -1
+        self.tile_size = tile_size
+        self.cols = size[0] // tile_size
+        self.rows = size[1] // tile_size
+
+        # 每个格子占 1 bit
+        self.bits = bytearray((self.cols * self.rows + 7) // 8)
+        for cx, cy in TileMap.get_obstacle_cells(obstacles):
+            self.set_solid(cx, cy, True)
+
+        self.cell_centers = [Vector2((i % self.cols + 0.5) * tile_size, (i // self.cols + 0.5) * tile_size) for i in range(self.cols * self.rows)]
+        self.distances = array("i", [-1]) * (self.cols * self.rows)
+        self.flow = array("i", [-1]) * (self.cols * self.rows)
+        self.flow_target_cell = None
+
+        self.player = self.get_root().get_first_node_in_group("player")
+        self.bake()
+        self.add_in_group("tilemap")
+
+
+    def set_solid(self, cx: int, cy: int, solid: bool) -> None:
+        index = cy * self.cols + cx
+        if solid:
+            self.bits[index >> 3] |= 1 << (index & 7)
+        else:
+            self.bits[index >> 3] &= ~(1 << (index & 7)) & 0xFF
+
+
+    def is_solid_cell(self, cx: int, cy: int) -> bool:
+        # 场地外的格子视为空地, 敌人从场地外生成
+        if cx < 0 or cy < 0 or cx >= self.cols or cy >= self.rows:
+            return False
+        index = cy * self.cols + cx
+        return (self.bits[index >> 3] >> (index & 7)) & 1 == 1
+
+
+    def is_solid_at(self, x: float, y: float) -> bool:
+        return self.is_solid_cell(int(x // self.tile_size), int(y // self.tile_size))
+
+
+    def collides_rect(self, x: float, y: float, width: float, height: float) -> bool:
+        # 只检查矩形覆盖到的几个格子
+        tile_size = self.tile_size
+        for cy in range(int(y // tile_size), int((y + height - 1) // tile_size) + 1):
+            for cx in range(int(x // tile_size), int((x + width - 1) // tile_size) + 1):
+                if self.is_solid_cell(cx, cy):
+                    return True
+        return False
+
+
+    def move(self, pos: Vector2, size: Vector2, motion: Vector2) -> Vector2:
+        # 按 x, y 轴分别移动, 撞墙的轴保持不动, 这样可以贴着墙滑动
+        x = pos.x + motion.x
+        if self.collides_rect(x, pos.y, size.x, size.y):
+            x = pos.x
+        y = pos.y + motion.y
+        if self.collides_rect(x, y, size.x, size.y):
+            y = pos.y
+        return Vector2(x, y)
+
+
+    @classmethod
+    def render_layer(cls, size: tuple, cells: list, tile_size: int = TILE_SIZE) -> Surface:
+        # 大部分区域是空的, 用 colorkey + RLE 的不透明表面代替逐像素 alpha, 整屏 blit 时只拷贝有障碍物的部分
+        layer = Surface(size).convert()
+        layer.fill(cls.COLORKEY)
+        for cx, cy in cells:
+            rect = Rect(cx * tile_size, cy * tile_size, tile_size, tile_size)
+            layer.fill(cls.TILE_COLOR, rect)
+            pygame.draw.rect(layer, cls.BORDER_COLOR, rect, 2)
+        layer.set_colorkey(cls.COLORKEY, pygame.RLEACCEL)
+        return layer
+
+
+    @staticmethod
+    def get_obstacle_cells(obstacles: list) -> list:
+        return [(cx, cy) for x, y, w, h in obstacles for cy in range(y, y + h) for cx in range(x, x + w)]
+
+
+    def bake(self) -> None:
+        # 障碍物只预先绘制一次
+        cells = [(cx, cy) for cy in range(self.rows) for cx in range(self.cols) if self.is_solid_cell(cx, cy)]
+        self.image = TileMap.render_layer(self.image.get_size(), cells, self.tile_size)
+        self.mark_image_dirty()
+        self.flow_target_cell = None
+
+
+    def _build_flow_field(self, target_cx: int, target_cy: int) -> None:
+        cols, rows = self.cols, self.rows
+        distances = self.distances
+        for i in range(len(distances)):
+            distances[i] = -1
+
+        target = target_cy * cols + target_cx
+        distances[target] = 0
+        frontier = deque([target])
+        while len(frontier) > 0:
+            index = frontier.popleft()
+            cx, cy = index % cols, index // cols
+            for dx, dy in self.NEIGHBOURS:
+                nx, ny = cx + dx, cy + dy
+                if nx < 0 or ny < 0 or nx >= cols or ny >= rows:
+                    continue
+                if self.is_solid_cell(nx, ny):
+                    continue
+                # 斜向移动时不允许穿过墙角
+                if dx != 0 and dy != 0 and (self.is_solid_cell(cx + dx, cy) or self.is_solid_cell(cx, cy + dy)):
+                    continue
+                neighbour = ny * cols + nx
+                if distances[neighbour] == -1:
+                    distances[neighbour] = distances[index] + 1
+                    frontier.append(neighbour)
+
+        flow = self.flow
+        for index in range(len(flow)):
+            flow[index] = -1
+            distance = distances[index]
+            if distance <= 0:
+                continue
+            cx, cy = index % cols, index // cols
+            for dx, dy in self.NEIGHBOURS:
+                nx, ny = cx + dx, cy + dy
+                if nx < 0 or ny < 0 or nx >= cols or ny >= rows:
+                    continue
+                neighbour = ny * cols + nx
+                if distances[neighbour] == distance - 1:
+                    if dx != 0 and dy != 0 and (self.is_solid_cell(cx + dx, cy) or self.is_solid_cell(cx, cy + dy)):
+                        continue
+                    flow[index] = neighbour
+                    break
+        self.flow_target_cell = (target_cx, target_cy)
+
+
+    def get_flow_target(self, pos: Vector2) -> Vector2:
+        # 返回下一个格子的中心, 不在流场中 (场地外, 与玩家同格或不可达) 时返回 None; 返回值是共享的, 不要修改
+        cx, cy = int(pos[0] // self.tile_size), int(pos[1] // self.tile_size)
+        if cx < 0 or cy < 0 or cx >= self.cols or cy >= self.rows:
+            return None
+        next_index = self.flow[cy * self.cols + cx]
+        if next_index < 0:
+            return None
+        return self.cell_centers[next_index]
+
+
+    def update(self, delta: float) -> None:
+        # 玩家所在的格子变化时才重新计算流场, 所有敌人共用
+        center = self.player.get_rect().center
+        cx = pygame.math.clamp(int(center[0] // self.tile_size), 0, self.cols - 1)
+        cy = pygame.math.clamp(int(center[1] // self.tile_size), 0, self.rows - 1)
+        if self.flow_target_cell != (cx, cy):
+            self._build_flow_field(cx, cy)
+
+
+
 class Bullet(Sprite2D):
 
+    shared_image = None
+
     def __init__(self, parent: Node2D, pos: Vector2, direction: Vector2):
-        super().__init__(parent, pos, Surface((10, 10)))
+        super().__init__(parent, pos, Bullet.get_shared_image())
         self.speed = 800
         self.damage = 5
         self.knockback_force = 5
         self.can_penetrate = False
         self.direction = direction
         self.z_index = 2
-        self.image.set_colorkey((0, 0, 0))
         self.can_collide = True
+        self.tilemap = None
         self.pos -= self.size / 2
 
 
@@ -326,18 +939,28 @@ class Bullet(Sprite2D):
         rect = pygame.display.get_surface().get_rect()
         if self.pos.x < 0 or self.pos.x > rect.width or self.pos.y < 0 or self.pos.y > rect.height:
             self.remove()
+        elif self.tilemap is not None and self.tilemap.is_solid_at(self.pos.x + self.size.x / 2, self.pos.y + self.size.y / 2):
+            self.remove()
 
-    
-    def draw(self, surface: Surface) -> None:
-        pygame.draw.circle(self.image, (0, 255, 0), self.size / 2, self.size.x / 2)
-        super().draw(surface)
+
+    @classmethod
+    def get_shared_image(cls) -> Surface:
+        # 所有子弹的外观相同, 共用一张图像
+        if cls.shared_image is None:
+            cls.shared_image = Surface((10, 10))
+            cls.shared_image.set_colorkey((0, 0, 0))
+            pygame.draw.circle(cls.shared_image, (0, 255, 0), (5, 5), 5)
+        return cls.shared_image
 
 
 class Gun(Node2D):
 
+    spread_tables = {}
+
     def __init__(self, parent: Node2D):
         super().__init__(parent, Vector2(parent.get_rect().center), Vector2())
         self.z_index = 3
+        self.set_local_pos(parent.size / 2)
         
         self.__laste_fire_time = 0
         self.firing_rate = 3
@@ -346,46 +969,175 @@ class Gun(Node2D):
         self.bullet_knockback_force = 5
         self.bullet_can_penetrate = False
         self.fire_bullet_count = 1
+        self.spread_pattern = "fan"
+        self.spread_angle = 5
+        self.__random_offset = 0
 
     
-    def _create_bullet(self, direction: Vector2) -> None:
-        bullet = Bullet(self, self.pos.copy(), direction)
+    @classmethod
+    def get_spread_table(cls, pattern: str, count: int, spread_angle: float) -> list:
+        # 以 +x 方向为基准的单位方向表, 每项为 (cos, sin), 按 (pattern, count, spread_angle) 缓存
+        key = (pattern, count, spread_angle)
+        table = cls.spread_tables.get(key)
+        if table is not None:
+            return table
+
+        if pattern == "ring":
+            angles = [i * 360.0 / count for i in range(count)]
+        elif pattern == "random_cone":
+            # 预先生成一组锥形内的随机角度, 发射时轮流取用
+            half = spread_angle * (count - 1) / 2
+            angles = [random.uniform(-half, half) for _ in range(max(count * 8, 64))]
+        else:
+            angles = [(i - (count - 1) / 2) * spread_angle for i in range(count)]
+
+        table = [(math.cos(math.radians(angle)), math.sin(math.radians(angle))) for angle in angles]
+        cls.spread_tables[key] = table
+        return table
+
+
+    def _create_bullet(self, direction: Vector2) -> "Bullet":
+        bullet = Bullet(None, self.pos.copy(), direction)
         bullet.can_penetrate = self.bullet_can_penetrate
         bullet.damage = self.bullet_damage
         bullet.speed = self.bullet_speed
         bullet.knockback_force = self.bullet_knockback_force
+        return bullet
 
-    
-    def _create_multiple_bullets(self, count: int, base_direction: Vector2, rotate_angle: float) -> None:
-        for i in range(1, count + 1):
-            angle = base_direction
-            if self.fire_bullet_count % 2 == 0:
-                if i == 1:
-                    angle = base_direction.rotate(rotate_angle / 2)
-                else:
-                    angle = base_direction.rotate((i-1) * rotate_angle + rotate_angle / 2)
-            else:
-                angle = base_direction.rotate(i * rotate_angle)
 
-            self._create_bullet(angle)
+    def _get_volley_directions(self, direction: Vector2) -> list:
+        count = self.fire_bullet_count
+        table = Gun.get_spread_table(self.spread_pattern, count, self.spread_angle)
+        if self.spread_pattern == "random_cone":
+            start = self.__random_offset
+            self.__random_offset = (start + count) % len(table)
+            table = [table[(start + i) % len(table)] for i in range(count)]
+
+        # 整组方向一次性旋转到瞄准方向, 不再逐颗调用 Vector2.rotate
+        x, y = direction.x, direction.y
+        return [Vector2(x * c - y * s, x * s + y * c) for c, s in table]
 
     
     def fire(self, direction: Vector2) -> None:
         if self.get_root().get_ticks() - self.__laste_fire_time < 1000.0 / self.firing_rate:
             return
 
-        half = self.fire_bullet_count // 2
-        self._create_multiple_bullets(half, direction, 5)
-
-        if not self.fire_bullet_count % 2 == 0:
-            self._create_bullet(direction)
+        max_bullet_count = self.get_root().governor.quality["max_bullet_count"]
+        if max_bullet_count > 0 and len(self.children) >= max_bullet_count:
+            return
 
-        self._create_multiple_bullets(half, direction, -5)
+        bullets = [self._create_bullet(d) for d in self._get_volley_directions(direction)]
+        tilemap = self.get_root().get_first_node_in_group("tilemap")
+        for bullet in bullets:
+            bullet.tilemap = tilemap
+        self.add_children(bullets)
 
         self.__laste_fire_time = self.get_root().get_ticks()
         
 
 
+class InputController:
+
+    def get_move_direction(self, player: "Player") -> Vector2:
+        return Vector2()
+
+    def get_aim_direction(self, player: "Player") -> Vector2:
+        return Vector2()
+
+    def choose_buff(self, player: "Player", buffs: list) -> int:
+        # 返回 -1 表示等待玩家点击
+        return -1
+
+    def should_restart(self, player: "Player") -> bool:
+        return False
+
+
+class HumanController(InputController):
+
+    def get_move_direction(self, player: "Player") -> Vector2:
+        keys = pygame.key.get_pressed()
+        direction = Vector2()
+        if keys[pygame.K_w]:
+            direction.y = -1
+        if keys[pygame.K_s]:
+            direction.y = 1
+        if keys[pygame.K_a]:
+            direction.x = -1
+        if keys[pygame.K_d]:
+            direction.x = 1
+        return direction
+
+    def get_aim_direction(self, player: "Player") -> Vector2:
+        return Vector2(player.get_root().mouse_pos) - player.get_rect().center
+
+
+class BotController(InputController):
+
+    def __init__(self):
+        self.kite_distance = 250
+        self.wall_margin = 120
+        self.low_health_ratio = 0.5
+        self.buff_priority = [FireBulletCountBuff, FireRateBuff, BulletDamage, BulletKnockbackForce, BulletSpeed, HealthBuff]
+
+    def _get_enemies(self, player: "Player") -> list:
+        scene = player.get_root().get_first_node_in_group("main_scene")
+        if scene is None:
+            return []
+        return scene.enemies.children
+
+    def _get_nearest_enemy(self, player: "Player") -> "Enemy":
+        center = Vector2(player.get_rect().center)
+        nearest = None
+        nearest_distance = 0
+        for enemy in self._get_enemies(player):
+            if enemy.is_removed:
+                continue
+            distance = center.distance_squared_to(enemy.get_rect().center)
+            if nearest is None or distance < nearest_distance:
+                nearest = enemy
+                nearest_distance = distance
+        return nearest
+
+    def get_move_direction(self, player: "Player") -> Vector2:
+        center = Vector2(player.get_rect().center)
+        direction = Vector2()
+        enemy = self._get_nearest_enemy(player)
+        if enemy is not None:
+            away = center - enemy.get_rect().center
+            if 0 < away.length() < self.kite_distance:
+                direction += away.normalize()
+
+        # 靠近边界时往场地中心拉回, 避免被逼到角落
+        limit = player.limit_rect
+        if center.x - limit.left < self.wall_margin or limit.right - center.x < self.wall_margin \
+                or center.y - limit.top < self.wall_margin or limit.bottom - center.y < self.wall_margin:
+            to_center = Vector2(limit.center) - center
+            if to_center.length() != 0:
+                direction += to_center.normalize()
+        return direction
+
+    def get_aim_direction(self, player: "Player") -> Vector2:
+        enemy = self._get_nearest_enemy(player)
+        if enemy is None:
+            return Vector2()
+        return Vector2(enemy.get_rect().center) - player.get_rect().center
+
+    def choose_buff(self, player: "Player", buffs: list) -> int:
+        if player.health < player.max_health * self.low_health_ratio:
+            for i, buff in enumerate(buffs):
+                if isinstance(buff, HealthBuff):
+                    return i
+        for buff_type in self.buff_priority:
+            for i, buff in enumerate(buffs):
+                if isinstance(buff, buff_type):
+                    return i
+        return 0
+
+    def should_restart(self, player: "Player") -> bool:
+        return True
+
+
+
 class Player(Sprite2D):
 
     def __init__(self, parent: Node2D, pos: Vector2):
@@ -396,6 +1148,7 @@ class Player(Sprite2D):
         self.image.fill((255, 0, 0))
         self.limit_rect = Rect(pygame.display.get_surface().get_rect())
         self.died_signal = Signal()
+        self.controller = HumanController()
 
         self.max_health = 100
         self.health = self.max_health
@@ -403,6 +1156,7 @@ class Player(Sprite2D):
         self.kill_count = 0
 
         self.add_in_group("player")
+        self.tilemap = None
 
         self.gun = Gun(self)
         self.gun.bullet_damage = 50
@@ -427,20 +1181,14 @@ class Player(Sprite2D):
 
 
     def update(self, delta: float) -> None:
-        keys = pygame.key.get_pressed()
-        direction = Vector2()
-        if keys[pygame.K_w]:
-            direction.y = -1
-        if keys[pygame.K_s]:
-            direction.y = 1
-        if keys[pygame.K_a]:
-            direction.x = -1
-        if keys[pygame.K_d]:
-            direction.x = 1
+        direction = self.controller.get_move_direction(self)
         
         pos = self.pos
         direction = direction.normalize() if direction.length() != 0 else direction
-        pos += direction * self.speed * delta
+        if self.tilemap is not None:
+            pos = self.tilemap.move(pos, self.size, direction * self.speed * delta)
+        else:
+            pos += direction * self.speed * delta
 
         if pos.x < self.limit_rect.left:
             pos.x = self.limit_rect.left
@@ -453,9 +1201,8 @@ class Player(Sprite2D):
 
         self.pos = pos
         self.collision_rect.topleft = self.pos
-        self.gun.pos = Vector2(self.get_rect().center)
 
-        shoot_direction = Vector2(pygame.mouse.get_pos()) - self.get_rect().center
+        shoot_direction = self.controller.get_aim_direction(self)
         shoot_direction = shoot_direction.normalize() if shoot_direction.length()!= 0 else shoot_direction
         # if pygame.mouse.get_pressed()[0]:
         self.gun.fire(shoot_direction)
@@ -496,6 +1243,139 @@ class Player(Sprite2D):
         self.gun.fire_bullet_count = self._init_data["fire_bullet_count"]
 
 
+class ParticleSystem(Node2D):
+
+    def __init__(self, parent: Node2D, capacity: int = 2048, particle_size: int = 4, fade_steps: int = 8):
+        super().__init__(parent, Vector2(0, 0), Vector2(0, 0))
+        self.z_index = 4
+        self.capacity = capacity
+        self.particle_size = particle_size
+        self.fade_steps = fade_steps
+        self.damping = 0.9
+        self.count = 0
+
+        # 粒子数据按槽位存放在定长的平铺数组中, 存活的粒子始终紧凑地排在 [0, count) 内
+        self.pos_x = array("f", [0.0]) * capacity
+        self.pos_y = array("f", [0.0]) * capacity
+        self.vel_x = array("f", [0.0]) * capacity
+        self.vel_y = array("f", [0.0]) * capacity
+        self.life = array("f", [0.0]) * capacity
+        self.max_life = array("f", [1.0]) * capacity
+        self.color = array("H", [0]) * capacity
+
+        # 预先生成每种颜色的渐隐图像, 绘制时只需按剩余寿命挑选
+        self.colors = []
+        self.fade_images = []
+        self.__color_indices = {}
+        self.__scaled_fade_images = None
+        self.__scaled_fade_key = None
+        self.__blit_items = [[None, Rect(0, 0, particle_size, particle_size)] for _ in range(capacity)]
+        # 交给 blits 的列表, 长度随 count 增减, 每帧复用而不是重新切片
+        self.__blit_list = []
+
+        self.add_in_group("particles")
+
+
+    def get_color_index(self, color: tuple) -> int:
+        key = tuple(color)
+        index = self.__color_indices.get(key)
+        if index is not None:
+            return index
+
+        color = Color(color)
+        images = []
+        for i in range(1, self.fade_steps + 1):
+            image = Surface((self.particle_size, self.particle_size))
+            image.fill(color)
+            image.set_alpha(int(255 * i / self.fade_steps))
+            images.append(image)
+        self.colors.append(color)
+        self.fade_images.append(images)
+        index = len(self.colors) - 1
+        self.__color_indices[key] = index
+        return index
+
+
+    def emit(self, pos: Vector2, count: int, color: tuple, speed: float = 200, life: float = 0.4) -> None:
+        count = int(count * self.get_root().governor.quality["particle_burst_scale"])
+        color_index = self.get_color_index(color)
+        for _ in range(min(count, self.capacity - self.count)):
+            i = self.count
+            angle = random.uniform(0, math.tau)
+            velocity = random.uniform(speed * 0.3, speed)
+            self.pos_x[i] = pos[0]
+            self.pos_y[i] = pos[1]
+            self.vel_x[i] = math.cos(angle) * velocity
+            self.vel_y[i] = math.sin(angle) * velocity
+            self.life[i] = self.max_life[i] = random.uniform(life * 0.5, life)
+            self.color[i] = color_index
+            self.count += 1
+
+
+    def clear(self) -> None:
+        self.count = 0
+
+
+    def _move_slot(self, src: int, dst: int) -> None:
+        self.pos_x[dst] = self.pos_x[src]
+        self.pos_y[dst] = self.pos_y[src]
+        self.vel_x[dst] = self.vel_x[src]
+        self.vel_y[dst] = self.vel_y[src]
+        self.life[dst] = self.life[src]
+        self.max_life[dst] = self.max_life[src]
+        self.color[dst] = self.color[src]
+
+
+    def update(self, delta: float) -> None:
+        damping = self.damping ** (delta * 60)
+        pos_x, pos_y, vel_x, vel_y, life = self.pos_x, self.pos_y, self.vel_x, self.vel_y, self.life
+        i = 0
+        while i < self.count:
+            life[i] -= delta
+            if life[i] <= 0:
+                # 与最后一个存活的粒子交换, 槽位随即可被复用
+                self.count -= 1
+                self._move_slot(self.count, i)
+                continue
+            pos_x[i] += vel_x[i] * delta
+            pos_y[i] += vel_y[i] * delta
+            vel_x[i] *= damping
+            vel_y[i] *= damping
+            i += 1
+
+
+    def _get_fade_images(self, scale: float) -> list:
+        if scale == 1:
+            return self.fade_images
+        key = (scale, len(self.fade_images))
+        if self.__scaled_fade_key != key:
+            size = max(1, round(self.particle_size * scale))
+            self.__scaled_fade_images = [[pygame.transform.scale(image, (size, size)) for image in images] for images in self.fade_images]
+            self.__scaled_fade_key = key
+        return self.__scaled_fade_images
+
+
+    def draw(self, surface: Surface) -> None:
+        if not self.visible or self.count == 0: return
+        scale = self.get_render_scale(surface)
+        fade_images = self._get_fade_images(scale)
+        half = self.particle_size / 2
+        last_step = self.fade_steps - 1
+        blit_list = self.__blit_list
+        while len(blit_list) < self.count:
+            blit_list.append(self.__blit_items[len(blit_list)])
+        if len(blit_list) > self.count:
+            del blit_list[self.count:]
+        for i in range(self.count):
+            item = blit_list[i]
+            step = int(self.life[i] / self.max_life[i] * self.fade_steps)
+            item[0] = fade_images[self.color[i]][step if step < last_step else last_step]
+            item[1].x = (self.pos_x[i] - half) * scale
+            item[1].y = (self.pos_y[i] - half) * scale
+        surface.blits(blit_list, False)
+
+
+
 class Cursor(Sprite2D):
 
     def __init__(self, parent: Node2D):
@@ -505,30 +1385,36 @@ class Cursor(Sprite2D):
         self.color = Color((0, 255, 0))
         self.image.set_colorkey((0, 0, 0))
         self.can_paused = False
+        self.is_ui = True
         pygame.mouse.set_visible(False)
+        self.redraw()
 
 
     def update(self, delta: float) -> None:
-        self.pos = pygame.mouse.get_pos()
+        self.pos = self.get_root().mouse_pos
 
-    def draw(self, surface: Surface) -> None:
+    def redraw(self) -> None:
+        # 修改 color 或 thickness 后调用
+        self.image.fill((0, 0, 0))
         pygame.draw.line(self.image, self.color, Vector2(self.size.x / 2 - self.thickness / 2, 0), Vector2(self.size.x / 2 - self.thickness / 2, self.size.y), self.thickness)
         pygame.draw.line(self.image, self.color, Vector2(0, self.size.y / 2 - self.thickness / 2), Vector2(self.size.x, self.size.y / 2 - self.thickness / 2), self.thickness)
-        super().draw(surface)
+        self.mark_image_dirty()
 
 
 class Enemy(Sprite2D):
 
     init_data = {}
+    shared_image = None
 
     def __init__(self, parent: Node2D, pos: Vector2):
-        super().__init__(parent, pos, Surface((30, 30)))
+        super().__init__(parent, pos, Enemy.get_shared_image())
         self.speed = 80
         self.z_index = 0
-        self.image.fill((255, 255, 255))
         self.can_collide = True
 
         self.player = self.get_root().get_first_node_in_group("player")
+        self.particles = self.get_root().get_first_node_in_group("particles")
+        self.tilemap = self.get_root().get_first_node_in_group("tilemap")
 
         self.max_health = 500
         self.health = self.max_health
@@ -536,22 +1422,41 @@ class Enemy(Sprite2D):
         Enemy.init_data = self._get_init_data()
 
         self.health_bar = HealthBar(self, self.max_health, Vector2(self.pos.x, self.pos.y - 15), Vector2(self.size.x, 8), 2)
+        self.health_bar.set_local_pos(Vector2(0, -15))
 
         self.has_collided_signal.connect(self._on_has_collided_signal)
 
     def update(self, delta: float) -> None:
         self.collision_rect.topleft = self.pos
-        self.health_bar.pos = Vector2(self.pos.x, self.pos.y - 15)
+        self.health_bar.visible = self.get_root().governor.quality["enemy_health_bar"]
 
-        direction = Vector2(self.player.get_rect().center) - Vector2(self.get_rect().center)
+        center = Vector2(self.get_rect().center)
+        target = self.player.get_rect().center
+        if self.tilemap is not None:
+            flow_target = self.tilemap.get_flow_target(center)
+            if flow_target is not None:
+                target = flow_target
+
+        direction = Vector2(target) - center
         if direction.length()!= 0:
             direction = direction.normalize()
-        self.pos += direction * self.speed * delta
+        self._move(direction * self.speed * delta)
 
-    
-    def draw(self, surface: Surface) -> None:
-        pygame.draw.circle(self.image, (255, 0, 0), self.size / 2, 7.5)
-        super().draw(surface)
+
+    def _move(self, motion: Vector2) -> None:
+        if self.tilemap is not None:
+            self.pos = self.tilemap.move(self.pos, self.size, motion)
+        else:
+            self.pos += motion
+
+
+    @classmethod
+    def get_shared_image(cls) -> Surface:
+        if cls.shared_image is None:
+            cls.shared_image = Surface((30, 30))
+            cls.shared_image.fill((255, 255, 255))
+            pygame.draw.circle(cls.shared_image, (255, 0, 0), (15, 15), 7.5)
+        return cls.shared_image
 
     def _get_init_data(self) -> dict:
         return {
@@ -562,13 +1467,20 @@ class Enemy(Sprite2D):
     
 
     def _on_has_collided_signal(self, node: Node2D) -> None:
+        if self.is_removed or node.is_removed:
+            return
+
         if isinstance(node, Bullet):
             self.health -= node.damage
             self.health_bar.health = self.health
-            self.pos += node.direction * node.knockback_force
+            self._move(node.direction * node.knockback_force)
+            if self.particles is not None:
+                self.particles.emit(node.get_rect().center, 6, (0, 255, 0), 150, 0.25)
             if self.health <= 0:
                 self.player.score += 5
                 self.player.kill_count += 1
+                if self.particles is not None:
+                    self.particles.emit(self.get_rect().center, 24, (255, 255, 255), 300, 0.6)
                 self.remove()
             if not node.can_penetrate:
                 node.remove()
@@ -577,6 +1489,8 @@ class Enemy(Sprite2D):
             self.player.score -= 10
             self.player.set_health(self.player.health - 10)
             self.player.kill_count += 1
+            if self.particles is not None:
+                self.particles.emit(self.get_rect().center, 24, (255, 0, 0), 300, 0.6)
             self.remove()
 
 
@@ -588,18 +1502,41 @@ class Lable(Node2D):
         self.font_color = Color(255, 255, 255)
         self.text_surfaces = []
         self.__text = text
+        self.__last_refresh_time = 0
+        self.__rendered_text = None
+        self.__rendered_font = None
+        self.__rendered_color = None
+        self.__scaled_surfaces = []
+        self.__scaled_key = None
         self.set_text(text)
 
 
+    def _needs_render(self) -> bool:
+        return self.__text != self.__rendered_text or self.font is not self.__rendered_font or self.font_color != self.__rendered_color
+
+
     def update(self, delta: float) -> None:
+        # 文字内容、字体和颜色都没变时不重新渲染, 行的位置相对于 pos 保存
+        if not self._needs_render():
+            return
+        refresh_interval = self.get_root().governor.quality["lable_refresh_interval"]
+        now = pygame.time.get_ticks()
+        if len(self.text_surfaces) != 0 and now - self.__last_refresh_time < refresh_interval:
+            return
+        self.__last_refresh_time = now
+        self.__rendered_text = self.__text
+        self.__rendered_font = self.font
+        self.__rendered_color = Color(self.font_color)
+
         self.text_surfaces.clear()
+        self.__scaled_key = None
         lines = self.__text.split("\n")
         line_height = self.font.get_linesize()
-        y = self.pos.y
+        y = 0
         max_width = 0
         for line in lines:
             text_surface = self.font.render(line, True, self.font_color)
-            self.text_surfaces.append((text_surface, Vector2(self.pos.x, y)))
+            self.text_surfaces.append((text_surface, y))
             y += line_height
             if text_surface.get_width() > max_width:
                 max_width = text_surface.get_width()
@@ -608,8 +1545,19 @@ class Lable(Node2D):
 
 
     def draw(self, surface: Surface) -> None:
-        for text_surface, pos in self.text_surfaces:
-            surface.blit(text_surface, pos)
+        pos = self.pos
+        scale = self.get_render_scale(surface)
+        if scale == 1:
+            for text_surface, y in self.text_surfaces:
+                surface.blit(text_surface, (pos.x, pos.y + y))
+            return
+
+        if self.__scaled_key != scale:
+            self.__scaled_surfaces = [pygame.transform.scale(text_surface, (max(1, round(text_surface.get_width() * scale)), max(1, round(text_surface.get_height() * scale))))
+                                      for text_surface, _ in self.text_surfaces]
+            self.__scaled_key = scale
+        for scaled_surface, (_, y) in zip(self.__scaled_surfaces, self.text_surfaces):
+            surface.blit(scaled_surface, (pos.x * scale, (pos.y + y) * scale))
 
 
     def set_text(self, text: str) -> None:
@@ -635,48 +1583,89 @@ class Lable(Node2D):
 
 class Button(Node2D):
 
+    __z_index = 0
+
     def __init__(self, parent: Node2D, pos: Vector2,  text: str):
         super().__init__(parent, pos, Vector2())
         self.padding = Vector2(10)
-        self.is_pressed = False
         self.text_lbl = Lable(self, pos + self.padding, text)
+        self.text_lbl.set_local_pos(self.padding)
         self.bg_color = Color(0, 0, 0)
         self.border_color = Color(255, 255, 255)
         self.border_width = 3
-        self.hot_keys = []
-        self.hot_key_pressed = False
+        self.__hot_keys = []
         self.set_text(text)
         self.pressed_singal = Signal()
 
+        self.get_root().input.add_button(self)
+
     def update(self, delta: float) -> None:
-        self.size = Vector2(self.text_lbl.size) + self.padding * 2
-        self.text_lbl.pos = self.pos + self.padding 
+        self.size.update(self.text_lbl.size.x + self.padding.x * 2, self.text_lbl.size.y + self.padding.y * 2)
         self.text_lbl.z_index = self.z_index
         self.text_lbl.can_paused = self.can_paused
         self.text_lbl.visible = self.visible
 
-        if self.visible:
-            if pygame.mouse.get_pressed()[0] and self.get_rect().collidepoint(pygame.mouse.get_pos()) and not self.is_pressed:
-                self.pressed_singal.emit()
-                self.is_pressed = True
-            if not pygame.mouse.get_pressed()[0]:
-                self.is_pressed = False
 
-        keys = pygame.key.get_pressed()
-        for key in self.hot_keys:
-            if keys[key]:
-                if self.hot_key_pressed:
-                    break
-                self.pressed_singal.emit()
-                self.hot_key_pressed = True
-                break
-            else:
-                self.hot_key_pressed = False
+    @property
+    def z_index(self) -> int:
+        return self.__z_index
+
+
+    @z_index.setter
+    def z_index(self, value: int) -> None:
+        if value == self.__z_index:
+            return
+        self.__z_index = value
+        Root.instance.input.update_button(self)
+
+
+    def is_active(self) -> bool:
+        if not self.visible:
+            return False
+        return not (self.get_root().is_paused() and self.can_paused)
+
+
+    def add_hot_key(self, key: int) -> None:
+        if key in self.__hot_keys:
+            return
+        self.__hot_keys.append(key)
+        self.get_root().input.bind_key(key, self._on_hot_key_pressed)
+
+
+    def remove_hot_key(self, key: int) -> None:
+        if key not in self.__hot_keys:
+            return
+        self.__hot_keys.remove(key)
+        self.get_root().input.unbind_key(key, self._on_hot_key_pressed)
+
+
+    def get_hot_keys(self) -> list:
+        return self.__hot_keys[:]
+
+
+    def _release(self) -> None:
+        # 被移除的按钮不能再被点击或响应热键
+        # 子树释放时父节点已被断开, 这里不能用 get_root
+        dispatcher = Root.instance.input
+        dispatcher.remove_button(self)
+        for key in self.__hot_keys:
+            dispatcher.unbind_key(key, self._on_hot_key_pressed)
+        self.__hot_keys.clear()
+        super()._release()
+
+
+    def _on_hot_key_pressed(self) -> None:
+        # 热键不受按钮是否可见影响, 与原先轮询时的行为一致
+        if self.get_root().is_paused() and self.can_paused:
+            return
+        self.pressed_singal.emit()
 
         
     def draw(self, surface: Surface) -> None:
-        pygame.draw.rect(surface, self.bg_color, Rect(self.pos.x, self.pos.y, self.size.x, self.size.y))
-        pygame.draw.rect(surface, self.border_color, Rect(self.pos.x, self.pos.y, self.size.x, self.size.y), self.border_width)
+        scale = self.get_render_scale(surface)
+        rect = Rect(self.pos.x * scale, self.pos.y * scale, self.size.x * scale, self.size.y * scale)
+        pygame.draw.rect(surface, self.bg_color, rect)
+        pygame.draw.rect(surface, self.border_color, rect, max(1, round(self.border_width * scale)))
 
 
     def set_text(self, text: str) -> None:
@@ -694,8 +1683,10 @@ class BuffPanel(Sprite2D):
     def __init__(self, parent: Node2D):
         super().__init__(parent, Vector2(0, 0), Surface(pygame.display.get_surface().get_size(), pygame.SRCALPHA))
         self.image.fill(Color(0, 0, 0, 100))
+        self.static_in_pause = True
 
         self.buff_btns = []
+        self.buffs = []
         self.buff_btn1 = Button(self, Vector2(10, 10), "buff1")
         self.buff_btn2 = Button(self, Vector2(120, 10), "buff2")
         self.buff_btn3 = Button(self, Vector2(230, 10), "buff3")
@@ -710,21 +1701,38 @@ class BuffPanel(Sprite2D):
         for btn in self.buff_btns:
             btn.can_paused = self.can_paused
 
+        self.__layout_size = None
+
 
     def update(self, delta: float) -> None:
-        width = 0
-        max_height = 0
         for btn in self.buff_btns:
             btn.z_index = self.z_index
-            width += btn.size.x
-            if btn.size.y > max_height:
-                max_height = btn.size.y
-        
+            btn.visible = self.visible
+
+        if self.visible:
+            self._layout()
+
+        if self.visible and len(self.buffs) == len(self.buff_btns):
+            index = self.player.controller.choose_buff(self.player, self.buffs)
+            if index >= 0:
+                self.buff_btns[index].pressed_singal.emit()
+
+
+    def _layout(self) -> None:
+        # 按钮尺寸变化时才重新排列, 按钮的文字会跟随按钮移动
+        # 以每个按钮的尺寸为键, 总宽度相同但各按钮宽度不同时也要重新排列
+        layout_size = tuple((btn.size.x, btn.size.y) for btn in self.buff_btns)
+        if self.__layout_size == layout_size:
+            return
+        self.__layout_size = layout_size
+
+        width = sum(size[0] for size in layout_size)
+        max_height = max(size[1] for size in layout_size)
+
         pos = Vector2((self.size.x - width - 2 * 20) / 2, (self.size.y - max_height) / 2)
         for btn in self.buff_btns:
-            btn.pos = pos.copy()
+            btn.pos = pos
             pos.x += btn.size.x + 20
-            btn.visible = self.visible
         
 
     def draw(self, surface: Surface) -> None:
@@ -742,8 +1750,10 @@ class BuffPanel(Sprite2D):
         btn.set_text(f"{buff.name}\n{buff.desc}")
         btn.pressed_singal.disconnect_all()
         btn.pressed_singal.connect(lambda: self._on_buff_btn_pressed(buff))
+        self.buffs.append(buff)
 
     def display(self) -> None:
+        self.buffs.clear()
         for btn in self.buff_btns:
             self._bind_buff(btn)
             
@@ -757,6 +1767,7 @@ class GameOverPanel(Sprite2D):
         self.image.fill(Color(0, 0, 0, 100))
         self.z_index = 99
         self.can_paused = False
+        self.static_in_pause = True
         self.visible = False
 
         self.lbl = Lable(self, Vector2(), "游戏结束")
@@ -767,6 +1778,8 @@ class GameOverPanel(Sprite2D):
         self.restart_bnt = Button(self, Vector2(10, 10), "重新开始")
         self.restart_bnt.can_paused = False
 
+        self.player = self.get_root().get_first_node_in_group("player")
+
     
     def update(self, delta: float) -> None:
         self.lbl.visible = self.visible
@@ -775,10 +1788,12 @@ class GameOverPanel(Sprite2D):
         self.lbl.z_index = self.z_index
         self.restart_bnt.z_index = self.z_index
 
-        self.lbl.pos = (self.size - self.lbl.size) / 2
-        self.lbl.pos.y -= 100
-        self.restart_bnt.pos = (self.size - self.restart_bnt.size) / 2
-        self.restart_bnt.pos.y += self.lbl.size.y 
+        if self.visible:
+            self.lbl.pos = ((self.size.x - self.lbl.size.x) / 2, (self.size.y - self.lbl.size.y) / 2 - 100)
+            self.restart_bnt.pos = ((self.size.x - self.restart_bnt.size.x) / 2, (self.size.y - self.restart_bnt.size.y) / 2 + self.lbl.size.y)
+
+        if self.visible and self.player.controller.should_restart(self.player):
+            self.restart_bnt.pressed_singal.emit()
 
         
         
@@ -788,6 +1803,7 @@ class TopUI(Node2D):
     def __init__(self, parent: Node2D):
         super().__init__(parent, Vector2(0, 0), Vector2(pygame.display.get_surface().get_size()))
         self.z_index = 99
+        self.is_ui = True
         self.add_in_group("top_ui")
 
         self.player = self.get_root().get_first_node_in_group("player")
@@ -817,7 +1833,7 @@ class TopUI(Node2D):
         pause_btn = Button(self, Vector2(10, 10), "暂停")
         pause_btn.visible = False
         pause_btn.can_paused = False
-        pause_btn.hot_keys.append(pygame.K_ESCAPE)
+        pause_btn.add_hot_key(pygame.K_ESCAPE)
         def _on_pause_btn_pressed():
             if self.over_panel.visible: return
             if self.buff_panel.visible: return
@@ -864,10 +1880,15 @@ class MainScene(Node2D):
         self.update_buff_time = 10
         self.enemy_health = 500
         self.enemy_speed = 80
+        self.last_spawn_time = 0
+        self.add_in_group("main_scene")
         
         Cursor(self)
         self.player = Player(self, self.size / 2)
+        self.tilemap = TileMap(self)
+        self.player.tilemap = self.tilemap
         self.enemies = Node2D(self, Vector2(0, 0), Vector2(0, 0))
+        self.particles = ParticleSystem(self)
         self.top_ui = TopUI(self)
 
         self.player.died_signal.connect(self.game_over)
@@ -879,7 +1900,10 @@ class MainScene(Node2D):
     def update(self, delta: float) -> None:
         self.top_ui.update_timer_lbl(-self.over_time)
 
-        if len(self.enemies.children) < self.max_enemy_count:
+        spawn_interval = self.get_root().governor.quality["enemy_spawn_interval"]
+        can_spawn = self.get_root().get_ticks() - self.last_spawn_time >= spawn_interval
+        if len(self.enemies.children) < self.max_enemy_count and can_spawn:
+            self.last_spawn_time = self.get_root().get_ticks()
             pos = Vector2()
             flag = random.randrange(0, 4)
             if flag == 0:
@@ -895,10 +1919,6 @@ class MainScene(Node2D):
             enemy.health = self.enemy_health
             enemy.speed = self.enemy_speed
 
-        for enemy in self.enemies.children[:]:
-            if enemy.health <= 0:
-                self.enemies.remove_child(enemy)
-
         if self.get_root().get_ticks() - self.start_time >= self.update_buff_time * 1000:
             if int((self.get_root().get_ticks() - self.start_time) / 1000) % self.update_buff_time == 0:
                 self.get_root().pause(True)
@@ -920,6 +1940,7 @@ class MainScene(Node2D):
         self.enemy_speed = Enemy.init_data["speed"]
         self.enemies.remove_all_children()
         self.player.gun.remove_all_children()
+        self.particles.clear()
         self.top_ui.over_panel.visible = False
         self.start_time = self.get_root().get_ticks()
 
@@ -931,55 +1952,1028 @@ class Game:
     def __init__(self):
         self.screen = pygame.display.set_mode((1280, 720))
         self.clock = pygame.time.Clock()
+        self.fps = 120
         self.running = True
+        self.duration = 0
+        self.stats_interval = 0
+        # 大于 0 时 run_async 在每帧最后这段时间内忙等以提高帧时间精度, 代价是多占用 CPU; 默认关闭
+        self.async_spin_time = 0.0
+        self.background_tasks = set()
+        self.render_enabled = True
+        self.frame_started_signal = Signal()
+        self.frame_ended_signal = Signal()
+        self.render_scale = 1.0
+        self.smooth_scaling = False
+        self.ui_native = True
+        self.world_surface = None
+        self.deferred_ui_nodes = []
+        self.__last_stats_time = 0
+        self.__stats_frame_times = []
         self.root = Root()
         self.root.clear_color = Color(47, 47, 47)
+        self.root.governor.target_fps = self.fps
+        self.pause_backdrop = None
+        self.pause_nodes = []
+        self.pause_static_nodes = []
+        self.memory = MemoryTracker(self.root)
+        self.root.input.bind_key(pygame.K_F9, self.memory.dump)
 
         MainScene(self.root)
 
 
     def run(self) -> None:
         while self.running:
-            self.clock.tick(120)
+            self.clock.tick(self.fps)
+            self._step(self.clock.get_time() / 1000)
+            self._end_frame(self.clock.get_rawtime())
 
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    self.running = False
+        pygame.quit()
+
+
+    async def run_async(self) -> None:
+        # 与 run 相同的帧逻辑, 但帧之间把控制权交还给事件循环, 以便后台协程运行
+        loop = asyncio.get_running_loop()
+        frame_duration = 1.0 / self.fps
+        next_frame_time = loop.time()
+        self.clock.tick()
+        try:
+            while self.running:
+                start = time.perf_counter()
+                self.clock.tick()
+                self._step(self.clock.get_time() / 1000)
+                self._end_frame((time.perf_counter() - start) * 1000)
+
+                next_frame_time += frame_duration
+                now = loop.time()
+                if next_frame_time < now:
+                    # 落后时不追帧, 从当前时间重新计时
+                    next_frame_time = now
+                # 落后时也至少让出一次, 保证后台协程能运行
+                await asyncio.sleep(max(0.0, next_frame_time - now - self.async_spin_time))
+                # asyncio.sleep 的精度只有毫秒级, 开启 async_spin_time 时最后一小段用 sleep(0) 忙等到点
+                while self.async_spin_time > 0 and loop.time() < next_frame_time:
+                    await asyncio.sleep(0)
+        finally:
+            for task in list(self.background_tasks):
+                task.cancel()
+            await asyncio.gather(*self.background_tasks, return_exceptions=True)
+            pygame.quit()
+
+
+    def spawn(self, coro: Coroutine) -> asyncio.Task:
+        # 在 run_async 运行期间调度一个后台协程, 游戏结束时自动取消
+        task = asyncio.get_running_loop().create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self._on_background_task_done)
+        return task
+
+
+    def _on_background_task_done(self, task: asyncio.Task) -> None:
+        self.background_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("background task failed", exc_info=task.exception())
+
+
+    async def run_in_executor(self, func: Callable, *args):
+        # 把阻塞的 I/O 放到线程池执行, 不占用帧时间
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+    def _step(self, delta: float) -> None:
+        self.frame_started_signal.emit()
+        events = pygame.event.get()
+        for event in events:
+            if event.type == pygame.QUIT:
+                self.running = False
+        self.root.input.process(events)
+
+        self.root.update(delta)
+
+        if self.root.is_paused():
+            self._process_paused_frame(delta)
+        else:
+            self.pause_backdrop = None
+            self.pause_nodes.clear()
+            self.pause_static_nodes.clear()
+            self._process_frame(delta)
+
+        self.root.flush_removals()
             
-            self.screen.fill(self.root.clear_color)
+        if self.render_enabled:
+            pygame.display.flip()
 
-            delta = self.clock.get_time() / 1000
-            self.root.update(delta)
 
-            for node in sorted(self.root.get_all_children(), key=lambda node: node.z_index):
-                if self.root.is_paused() and node.can_paused:
-                    if node.visible:
-                        node.draw(self.screen)
-                    continue
+    def _end_frame(self, frame_time: float) -> None:
+        self.root.governor.record(frame_time)
+        self.memory.record_frame()
+        self.frame_ended_signal.emit(frame_time)
+
+        if self.stats_interval > 0:
+            self._record_stats(frame_time)
+        if self.duration > 0 and pygame.time.get_ticks() >= self.duration:
+            self.running = False
+
+
+    def _record_stats(self, frame_time: float) -> None:
+        self.__stats_frame_times.append(frame_time)
+        now = pygame.time.get_ticks()
+        if now - self.__last_stats_time < self.stats_interval:
+            return
+
+        nodes = self.root.get_all_children()
+        enemy_count = sum(1 for node in nodes if isinstance(node, Enemy))
+        bullet_count = sum(1 for node in nodes if isinstance(node, Bullet))
+        particles = self.root.get_first_node_in_group("particles")
+        frame_times = self.__stats_frame_times
+        logger.info("stats: frames %d, avg frame %.2fms, max frame %.2fms, fps %.1f, nodes %d, enemies %d, bullets %d, particles %d, quality %s",
+                    len(frame_times), sum(frame_times) / len(frame_times), max(frame_times), self.clock.get_fps(),
+                    len(nodes), enemy_count, bullet_count, 0 if particles is None else particles.count,
+                    self.root.governor.quality["name"])
+        self.__stats_frame_times = []
+        self.__last_stats_time = now
+
+
+    def set_render_scale(self, scale: float) -> None:
+        # 世界画在缩小的缓冲区上, 每帧放大一次到窗口; 游戏逻辑和鼠标仍使用窗口的逻辑坐标, 无需转换
+        self.render_scale = scale
+        if scale == 1:
+            self.world_surface = None
+            return
+        width, height = self.screen.get_size()
+        self.world_surface = Surface((max(1, round(width * scale)), max(1, round(height * scale)))).convert(self.screen)
+
+
+    def _draw_node(self, node: Node2D, world: Surface) -> None:
+        if self.world_surface is not None and self.ui_native and node.is_ui:
+            self.deferred_ui_nodes.append(node)
+            return
+        node.draw(world)
+
+
+    def _present(self, world: Surface, target: Surface) -> None:
+        if self.world_surface is not None:
+            if self.smooth_scaling:
+                pygame.transform.smoothscale(world, target.get_size(), target)
+            else:
+                pygame.transform.scale(world, target.get_size(), target)
+        for node in self.deferred_ui_nodes:
+            node.draw(target)
+        self.deferred_ui_nodes.clear()
+
+
+    def _process_frame(self, delta: float) -> None:
+        render = self.render_enabled
+        world = self.screen if self.world_surface is None else self.world_surface
+        if render:
+            world.fill(self.root.clear_color)
+
+        for node in sorted(self.root.get_all_children(), key=lambda node: node.z_index):
+            # 本帧内已被 remove 的节点等到帧末才摘下, 这之前既不更新也不绘制
+            if node.is_removed:
+                continue
+
+            if self.root.is_paused() and node.can_paused:
+                if node.visible and render:
+                    self._draw_node(node, world)
+                continue
+
+            node.update(delta)
+            if node.visible and render:
+                self._draw_node(node, world)
+
+            if isinstance(node, Bullet):
+                 for other_node in self.root.get_all_children():
+                    if node.parent == other_node: continue
+                    if not isinstance(other_node, Enemy) or other_node.is_removed: continue
+                    if node.is_removed: break
+                    if node.collision_rect.colliderect(other_node.collision_rect):
+                        other_node.has_collided_signal.emit(node)
+                        if not node.can_penetrate: 
+                            break
+            
+            if isinstance(node, Player):
+                for other_node in self.root.get_all_children():
+                    if not isinstance(other_node, Enemy) or other_node.is_removed: continue
+                    if node.collision_rect.colliderect(other_node.collision_rect):
+                        other_node.has_collided_signal.emit(node)
+
+        if render:
+            self._present(world, self.screen)
+
+
+    def _collect_pause_nodes(self) -> None:
+        self.pause_nodes.clear()
+        self.pause_static_nodes.clear()
+        for node in sorted(self.root.get_all_children(), key=lambda node: node.z_index):
+            if node.can_paused:
+                continue
+            self.pause_nodes.append(node)
+            if node.static_in_pause:
+                self.pause_static_nodes.append((node, node.visible))
+
+
+    def _get_pause_target(self) -> Surface:
+        # 界面画在低分辨率缓冲区上时, 暂停画面也在缓冲区上合成再放大; 否则直接画在窗口上
+        if self.world_surface is not None and not self.ui_native:
+            return self.world_surface
+        return self.screen
+
+
+    def _is_pause_backdrop_stale(self) -> bool:
+        for node, visible in self.pause_static_nodes:
+            if node.visible != visible:
+                return True
+        return False
+
+
+    def _capture_pause_backdrop(self) -> None:
+        # 暂停期间世界和静态遮罩都不变, 只合成一次; 之后每帧只重画按钮、文字和光标
+        for i in range(len(self.pause_static_nodes)):
+            node = self.pause_static_nodes[i][0]
+            self.pause_static_nodes[i] = (node, node.visible)
+
+        world = self.screen if self.world_surface is None else self.world_surface
+        world.fill(self.root.clear_color)
+        for node in sorted(self.root.get_all_children(), key=lambda node: node.z_index):
+            if (node.can_paused or node.static_in_pause) and node.visible and not node.is_removed:
+                self._draw_node(node, world)
+
+        self.pause_backdrop = Surface(self._get_pause_target().get_size()).convert(self.screen)
+        if self.world_surface is None:
+            self.pause_backdrop.blit(world, (0, 0))
+        else:
+            self._present(world, self.pause_backdrop)
+
+
+    def _process_paused_frame(self, delta: float) -> None:
+        if len(self.pause_nodes) == 0:
+            self._collect_pause_nodes()
+
+        render = self.render_enabled
+        if render and (self.pause_backdrop is None or self._is_pause_backdrop_stale()):
+            self._capture_pause_backdrop()
+
+        target = self._get_pause_target()
+        if render:
+            target.blit(self.pause_backdrop, (0, 0))
+        for node in self.pause_nodes:
+            if node.is_removed:
+                continue
+            node.update(delta)
+            if node.visible and render and not node.static_in_pause:
+                node.draw(target)
+        if render and target is not self.screen:
+            self._present(target, self.screen)
+
+
+class SnapshotCodec:
+
+    # 位置量化为 1/4 像素, 生命值量化为 0-255 的比例
+    POS_SCALE = 4
+    KIND_PLAYER = 0
+    KIND_ENEMY = 1
+    KIND_BULLET = 2
+    KIND_SIZES = {KIND_PLAYER: (60, 60), KIND_ENEMY: (30, 30), KIND_BULLET: (10, 10)}
 
-                node.update(delta)
-                if node.visible:
-                    node.draw(self.screen)
-
-                if isinstance(node, Bullet):
-                     for other_node in self.root.get_all_children():
-                        if node.parent == other_node: continue
-                        if not isinstance(other_node, Enemy): continue
-                        if node.collision_rect.colliderect(other_node.collision_rect):
-                            other_node.has_collided_signal.emit(node)
-                            if not node.can_penetrate: 
-                                break
-                
-                if isinstance(node, Player):
-                    for other_node in self.root.get_all_children():
-                        if not isinstance(other_node, Enemy): continue
-                        if node.collision_rect.colliderect(other_node.collision_rect):
-                            other_node.has_collided_signal.emit(node)
-                
+    FLAG_PAUSED = 1
+    FLAG_GAME_OVER = 2
+    FLAG_BUFF_PANEL = 4
+
+    # tick, 服务端时间 (毫秒), 分数, 击杀数, 生命值, 最大生命值, 标志位, 变化的实体数, 移除的实体数
+    HEADER = struct.Struct("<IIiIiiBHH")
+    ENTITY = struct.Struct("<IBhhB")
+    REMOVED = struct.Struct("<I")
+
+    def __init__(self):
+        # 编码和解码两端各自保存上一次的快照, 只传输变化的实体; 依赖 TCP 的有序可靠传输, 无需确认
+        self.baseline = {}
+
+
+    @classmethod
+    def _quantize_pos(cls, value: float) -> int:
+        return int(pygame.math.clamp(round(value * cls.POS_SCALE), -32768, 32767))
+
+
+    @classmethod
+    def _quantize_health(cls, health: float, max_health: float) -> int:
+        if max_health <= 0:
+            return 0
+        return int(pygame.math.clamp(round(health * 255 / max_health), 0, 255))
+
+
+    @classmethod
+    def capture(cls, scene: "MainScene") -> tuple:
+        player = scene.player
+        entities = {}
+        entities[player.net_id] = (cls.KIND_PLAYER, cls._quantize_pos(player.pos.x), cls._quantize_pos(player.pos.y),
+                                   cls._quantize_health(player.health, player.max_health))
+        for enemy in scene.enemies.children:
+            entities[enemy.net_id] = (cls.KIND_ENEMY, cls._quantize_pos(enemy.pos.x), cls._quantize_pos(enemy.pos.y),
+                                      cls._quantize_health(enemy.health, enemy.max_health))
+        for bullet in player.gun.children:
+            entities[bullet.net_id] = (cls.KIND_BULLET, cls._quantize_pos(bullet.pos.x), cls._quantize_pos(bullet.pos.y), 0)
+
+        flags = 0
+        if scene.get_root().is_paused():
+            flags |= cls.FLAG_PAUSED
+        if scene.top_ui.over_panel.visible:
+            flags |= cls.FLAG_GAME_OVER
+        if scene.top_ui.buff_panel.visible:
+            flags |= cls.FLAG_BUFF_PANEL
+        header = (int(player.score), int(player.kill_count), int(player.health), int(player.max_health), flags)
+        return header, entities
+
+
+    def encode(self, tick: int, server_time: int, header: tuple, entities: dict) -> bytes:
+        baseline = self.baseline
+        changed = [(net_id,) + entity for net_id, entity in entities.items() if baseline.get(net_id) != entity]
+        removed = [net_id for net_id in baseline if net_id not in entities]
+        self.baseline = entities
+
+        data = self.HEADER.pack(tick, server_time, *header, len(changed), len(removed))
+        if len(changed) > 0:
+            data += struct.pack("<" + "IBhhB" * len(changed), *itertools.chain.from_iterable(changed))
+        if len(removed) > 0:
+            data += struct.pack(f"<{len(removed)}I", *removed)
+        return data
+
+
+    def decode(self, data: bytes) -> tuple:
+        tick, server_time, score, kill_count, health, max_health, flags, changed_count, removed_count = self.HEADER.unpack_from(data, 0)
+        offset = self.HEADER.size
+
+        entities = dict(self.baseline)
+        end = offset + changed_count * self.ENTITY.size
+        for net_id, kind, x, y, health_value in self.ENTITY.iter_unpack(data[offset:end]):
+            entities[net_id] = (kind, x, y, health_value)
+        offset = end
+        end = offset + removed_count * self.REMOVED.size
+        for (net_id,) in self.REMOVED.iter_unpack(data[offset:end]):
+            entities.pop(net_id, None)
+
+        self.baseline = entities
+        return tick, server_time / 1000, (score, kill_count, health, max_health, flags), entities
+
+
+
+class NetConnection:
+
+    LENGTH = struct.Struct("<I")
+
+    def __init__(self, sock: socket.socket, max_buffer: int = 4 * 1024 * 1024):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.max_buffer = max_buffer
+        self.closed = False
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+        self.__send_buffer = bytearray()
+        self.__recv_buffer = bytearray()
+
+
+    def send_message(self, payload: bytes) -> None:
+        if self.closed:
+            return
+        self.__send_buffer += self.LENGTH.pack(len(payload))
+        self.__send_buffer += payload
+        if len(self.__send_buffer) > self.max_buffer:
+            # 对端读得太慢, 直接断开而不是无限堆积
+            logger.warning("net: send buffer overflow, closing connection")
+            self.close()
+            return
+        self.flush()
+
+
+    def flush(self) -> None:
+        while len(self.__send_buffer) > 0 and not self.closed:
+            try:
+                sent = self.sock.send(self.__send_buffer)
+            except BlockingIOError:
+                return
+            except OSError:
+                self.close()
+                return
+            self.bytes_sent += sent
+            del self.__send_buffer[:sent]
+
+
+    def receive_messages(self) -> list:
+        messages = []
+        while not self.closed:
+            try:
+                data = self.sock.recv(65536)
+            except BlockingIOError:
+                break
+            except OSError:
+                self.close()
+                break
+            if len(data) == 0:
+                self.close()
+                break
+            self.bytes_received += len(data)
+            self.__recv_buffer += data
+
+        buffer = self.__recv_buffer
+        offset = 0
+        while len(buffer) - offset >= self.LENGTH.size:
+            (length,) = self.LENGTH.unpack_from(buffer, offset)
+            if len(buffer) - offset - self.LENGTH.size < length:
+                break
+            start = offset + self.LENGTH.size
+            messages.append(bytes(buffer[start:start + length]))
+            offset = start + length
+        del buffer[:offset]
+        return messages
+
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.sock.close()
+
+
+
+class RemoteController(BotController):
+
+    INPUT = struct.Struct("<hhhh")
+
+    def __init__(self):
+        super().__init__()
+        self.connected = False
+        self.move_direction = Vector2()
+        self.aim_direction = Vector2()
+
+
+    def apply_input(self, data: bytes) -> None:
+        move_x, move_y, aim_x, aim_y = self.INPUT.unpack(data)
+        self.move_direction.update(move_x / 1000, move_y / 1000)
+        self.aim_direction.update(aim_x / 1000, aim_y / 1000)
+
+
+    def get_move_direction(self, player: "Player") -> Vector2:
+        # 没有客户端操作时由机器人接管, 选择 buff 和重新开始也交给机器人
+        if not self.connected:
+            return super().get_move_direction(player)
+        return self.move_direction
+
+
+    def get_aim_direction(self, player: "Player") -> Vector2:
+        if not self.connected:
+            return super().get_aim_direction(player)
+        return self.aim_direction
+
+
+
+class SnapshotServer:
+
+    def __init__(self, game: Game, host: str, port: int, snapshot_rate: int = 30, remote_control: bool = True):
+        self.game = game
+        self.scene = game.root.get_first_node_in_group("main_scene")
+        self.snapshot_rate = snapshot_rate
+        # 按实际经过的时间发送快照, 不受服务端帧率影响; 快照里带上服务端时间供客户端插值
+        self.snapshot_period = 1.0 / snapshot_rate
+        self.start_time = time.perf_counter()
+        self.next_snapshot_time = self.start_time
+        self.stats_interval = 5000
+        self.tick = 0
+        self.clients = []
+        self.last_snapshot = None
+
+        self.listener = socket.create_server((host, port))
+        self.listener.setblocking(False)
+        self.address = self.listener.getsockname()
+
+        self.controller = None
+        if remote_control:
+            self.controller = RemoteController()
+            self.scene.player.controller = self.controller
+
+        self.__stats_ticks = 0
+        self.__stats_bytes = 0
+        self.__stats_encode_time = 0.0
+        self.__last_stats_time = pygame.time.get_ticks()
+
+        game.frame_ended_signal.connect(self._on_frame_ended)
+        logger.info("net: server listening on %s:%d", *self.address[:2])
+
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except BlockingIOError:
+                return
+            logger.info("net: client connected from %s:%d", *address[:2])
+            self.clients.append((NetConnection(sock), SnapshotCodec()))
+
+
+    def _poll_input(self) -> None:
+        for connection, _ in self.clients:
+            for message in connection.receive_messages():
+                if self.controller is not None and len(message) == RemoteController.INPUT.size:
+                    self.controller.apply_input(message)
+
+        for client in self.clients[:]:
+            if client[0].closed:
+                logger.info("net: client disconnected")
+                self.clients.remove(client)
+        if self.controller is not None:
+            self.controller.connected = len(self.clients) > 0
+
+
+    def _on_frame_ended(self, frame_time: float) -> None:
+        self._accept()
+        self._poll_input()
+
+        start = time.perf_counter()
+        if start < self.next_snapshot_time:
+            return
+        self.next_snapshot_time += self.snapshot_period
+        if self.next_snapshot_time < start:
+            # 落后超过一个周期时不补发, 从当前时间重新排
+            self.next_snapshot_time = start + self.snapshot_period
+
+        self.tick += 1
+        server_time = int((start - self.start_time) * 1000)
+        header, entities = SnapshotCodec.capture(self.scene)
+        self.last_snapshot = (self.tick, header, entities)
+        for connection, codec in self.clients:
+            data = codec.encode(self.tick, server_time, header, entities)
+            connection.send_message(data)
+            self.__stats_bytes += len(data) + NetConnection.LENGTH.size
+        self.__stats_encode_time += time.perf_counter() - start
+        self.__stats_ticks += 1
+
+        now = pygame.time.get_ticks()
+        if now - self.__last_stats_time >= self.stats_interval:
+            seconds = (now - self.__last_stats_time) / 1000
+            logger.info("net: server ticks %d, clients %d, entities %d, avg %.1fB/tick, %.2fKiB/s, avg serialise %.1fus/tick",
+                        self.__stats_ticks, len(self.clients), len(entities), self.__stats_bytes / self.__stats_ticks,
+                        self.__stats_bytes / 1024 / seconds, self.__stats_encode_time * 1e6 / self.__stats_ticks)
+            self.__stats_ticks = 0
+            self.__stats_bytes = 0
+            self.__stats_encode_time = 0.0
+            self.__last_stats_time = now
+
+
+    def close(self) -> None:
+        for connection, _ in self.clients:
+            connection.close()
+        self.clients.clear()
+        self.listener.close()
+
+
+
+class SnapshotClient:
+
+    def __init__(self, host: str, port: int, fps: int = 120):
+        self.screen = pygame.display.set_mode((1280, 720))
+        self.clock = pygame.time.Clock()
+        self.fps = fps
+        self.running = True
+        self.duration = 0
+        self.clear_color = Color(47, 47, 47)
+        self.font = pygame.font.SysFont("SimHei", 30)
+        self.interpolation_delay = 0.1
+        self.stats_interval = 5000
+        self.snapshots = deque(maxlen=32)
+        # 本地时钟减服务端时间的最小值, 即延迟最小的那次到达; 用来把本地时间换算成服务端时间
+        self.time_offset = None
+        self.codec = SnapshotCodec()
+        self.connection = NetConnection(socket.create_connection((host, port)))
+
+        # 障碍物是静态的, 与服务端使用同一份默认布局, 只绘制一次
+        self.obstacles = TileMap.render_layer(self.screen.get_size(), TileMap.get_obstacle_cells(DefaultObstacles))
+
+        self.__stats_snapshots = 0
+        self.__stats_decode_time = 0.0
+        self.__stats_bytes = 0
+        self.__last_stats_time = pygame.time.get_ticks()
+        logger.info("net: client connected to %s:%d", host, port)
+
+
+    def run(self) -> None:
+        while self.running and not self.connection.closed:
+            self.clock.tick(self.fps)
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    self.running = False
+
+            self._receive()
+            header, entities = None, {}
+            if self.time_offset is not None:
+                header, entities = self._interpolate(time.perf_counter() - self.time_offset - self.interpolation_delay)
+            self._send_input(entities)
+            self._draw(header, entities)
             pygame.display.flip()
 
+            self._record_stats()
+            if self.duration > 0 and pygame.time.get_ticks() >= self.duration:
+                self.running = False
+
+        self.connection.close()
         pygame.quit()
 
 
-Game().run()
+    def _receive(self) -> None:
+        messages = self.connection.receive_messages()
+        start = time.perf_counter()
+        for message in messages:
+            tick, server_time, header, entities = self.codec.decode(message)
+            # 按服务端时间插值, 同一次读到的多条快照不会挤在同一时刻
+            offset = start - server_time
+            if self.time_offset is None or offset < self.time_offset:
+                self.time_offset = offset
+            self.snapshots.append((server_time, header, entities))
+            self.__stats_bytes += len(message) + NetConnection.LENGTH.size
+        self.__stats_decode_time += time.perf_counter() - start
+        self.__stats_snapshots += len(messages)
+
+
+    def _interpolate(self, render_time: float) -> tuple:
+        if len(self.snapshots) == 0:
+            return None, {}
+
+        older = None
+        newer = None
+        for snapshot in self.snapshots:
+            if snapshot[0] <= render_time:
+                older = snapshot
+            else:
+                newer = snapshot
+                break
+        if older is None:
+            return newer[1], newer[2]
+        if newer is None:
+            return older[1], older[2]
+
+        # 只对两次快照中都存在的实体插值, 新出现的实体直接使用新位置
+        t = (render_time - older[0]) / (newer[0] - older[0])
+        old_entities = older[2]
+        entities = {}
+        for net_id, (kind, x, y, health) in newer[2].items():
+            old = old_entities.get(net_id)
+            if old is not None:
+                x = old[1] + (x - old[1]) * t
+                y = old[2] + (y - old[2]) * t
+            entities[net_id] = (kind, x, y, health)
+        return newer[1], entities
+
+
+    def _send_input(self, entities: dict) -> None:
+        keys = pygame.key.get_pressed()
+        move = Vector2(keys[pygame.K_d] - keys[pygame.K_a], keys[pygame.K_s] - keys[pygame.K_w])
+        if move.length() != 0:
+            move = move.normalize()
+
+        aim = Vector2()
+        for kind, x, y, _ in entities.values():
+            if kind == SnapshotCodec.KIND_PLAYER:
+                width, height = SnapshotCodec.KIND_SIZES[kind]
+                aim = Vector2(pygame.mouse.get_pos()) - Vector2(x / SnapshotCodec.POS_SCALE + width / 2, y / SnapshotCodec.POS_SCALE + height / 2)
+                break
+        if aim.length() != 0:
+            aim = aim.normalize()
+
+        self.connection.send_message(RemoteController.INPUT.pack(int(move.x * 1000), int(move.y * 1000), int(aim.x * 1000), int(aim.y * 1000)))
+
+
+    def _draw(self, header: tuple, entities: dict) -> None:
+        self.screen.fill(self.clear_color)
+        self.screen.blit(self.obstacles, (0, 0))
+        for kind, x, y, health in entities.values():
+            pos = Vector2(x, y) / SnapshotCodec.POS_SCALE
+            width, height = SnapshotCodec.KIND_SIZES[kind]
+            if kind == SnapshotCodec.KIND_PLAYER:
+                pygame.draw.rect(self.screen, (255, 0, 0), Rect(pos, (width, height)))
+            elif kind == SnapshotCodec.KIND_ENEMY:
+                pygame.draw.rect(self.screen, (255, 255, 255), Rect(pos, (width, height)))
+                pygame.draw.circle(self.screen, (255, 0, 0), pos + Vector2(width, height) / 2, 7.5)
+                pygame.draw.rect(self.screen, (255, 255, 255), Rect(pos.x, pos.y - 15, width, 8), 2)
+                pygame.draw.rect(self.screen, (255, 0, 0), Rect(pos.x + 2, pos.y - 13, (width - 4) * health / 255, 4))
+            else:
+                pygame.draw.circle(self.screen, (0, 255, 0), pos + Vector2(width, height) / 2, width / 2)
+
+        if header is not None:
+            score, kill_count, health, max_health, flags = header
+            text = f"分数: {score}    击杀: {kill_count}    {health}/{max_health}"
+            if flags & SnapshotCodec.FLAG_GAME_OVER:
+                text += "    游戏结束"
+            elif flags & SnapshotCodec.FLAG_PAUSED:
+                text += "    暂停"
+            self.screen.blit(self.font.render(text, True, (255, 255, 255)), (10, 10))
+
+
+    def _record_stats(self) -> None:
+        now = pygame.time.get_ticks()
+        if now - self.__last_stats_time < self.stats_interval:
+            return
+        seconds = (now - self.__last_stats_time) / 1000
+        snapshots = max(1, self.__stats_snapshots)
+        logger.info("net: client snapshots %d, avg %.1fB/snapshot, %.2fKiB/s, avg deserialise %.1fus/snapshot, fps %.1f",
+                    self.__stats_snapshots, self.__stats_bytes / snapshots, self.__stats_bytes / 1024 / seconds,
+                    self.__stats_decode_time * 1e6 / snapshots, self.clock.get_fps())
+        self.__stats_snapshots = 0
+        self.__stats_decode_time = 0.0
+        self.__stats_bytes = 0
+        self.__last_stats_time = now
+
+
+
+class FrameRecorder:
+
+    def __init__(self, game: Game, path: str, capture_fps: float = 60, scale: float = 1.0, pool_size: int = 8, direct: bool = False):
+        self.game = game
+        self.path = path
+        width, height = game.screen.get_size()
+        self.size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        # direct 模式 (无窗口且不缩放) 下把空闲缓冲直接交给 Game 作为这一帧的画布, 画完整个缓冲交给写线程, 没有额外拷贝;
+        # 有窗口时画面必须画到窗口上, 只能每次录制时把窗口 blit (或缩放) 到缓冲里, 这一次整帧拷贝是主线程上的主要开销
+        self.direct = direct and self.size == game.screen.get_size()
+        self.display_surface = game.screen
+        self.target_slot = None
+        # 按实际经过的时间安排录制, 游戏掉帧时不会因为按帧计数而让视频播放变快
+        self.capture_fps = capture_fps
+        self.capture_period = 1.0 / capture_fps
+        self.next_capture_time = None
+        self.timestamps = []
+
+        # 预先分配固定数量的帧缓冲, 写线程直接把缓冲的内存写入文件, 没有空闲缓冲时丢帧
+        self.free_slots = queue.Queue()
+        for _ in range(pool_size):
+            self.free_slots.put(Surface(self.size, 0, 32))
+        self.pending = queue.Queue()
+        self.file = open(path, "wb")
+
+        self.frame_count = 0
+        self.captured = 0
+        self.dropped = 0
+        self.bytes_written = 0
+        self.capture_time = 0.0
+        self.total_frame_time = 0.0
+
+        self.pixel_format = self._get_pixel_format(self.free_slots.queue[0])
+        self._write_sidecar(capture_fps)
+
+        self.thread = threading.Thread(target=self._write_loop, name="frame-writer", daemon=True)
+        self.thread.start()
+        if self.direct:
+            game.frame_started_signal.connect(self._on_frame_started)
+        game.frame_ended_signal.connect(self._on_frame_ended)
+        logger.info("capture: writing raw %s %dx%d to %s at up to %g fps (%s)",
+                    self.pixel_format, *self.size, path, capture_fps, "direct" if self.direct else "copy")
+
+
+    def get_actual_fps(self) -> float:
+        if len(self.timestamps) < 2:
+            return self.capture_fps
+        return (len(self.timestamps) - 1) / (self.timestamps[-1] - self.timestamps[0])
+
+
+    def _write_sidecar(self, fps: float) -> None:
+        # fps 是实际录到的平均帧率, timestamps 是每一帧相对第一帧的秒数, 可用于按真实时间重建
+        with open(self.path + ".json", "w") as file:
+            json.dump({"width": self.size[0], "height": self.size[1], "pix_fmt": self.pixel_format,
+                       "fps": fps, "nominal_fps": self.capture_fps,
+                       "timestamps": [round(t - self.timestamps[0], 6) for t in self.timestamps]}, file)
+
+
+    @staticmethod
+    def _get_pixel_format(surface: Surface) -> str:
+        # 按内存中的字节顺序给出 ffmpeg 的像素格式名, 例如 bgr0
+        names = []
+        for i in range(4):
+            shift = i * 8 if sys.byteorder == "little" else (3 - i) * 8
+            name = "0"
+            for channel, mask, channel_shift in zip("rgba", surface.get_masks(), surface.get_shifts()):
+                if mask != 0 and channel_shift == shift:
+                    name = channel
+            names.append(name)
+        return "".join(names)
+
+
+    def _is_capture_due(self, now: float) -> bool:
+        if self.next_capture_time is None:
+            self.next_capture_time = now
+        if now < self.next_capture_time:
+            return False
+        self.next_capture_time += self.capture_period
+        if self.next_capture_time < now:
+            # 落后超过一帧时不补录, 从当前时间重新排
+            self.next_capture_time = now + self.capture_period
+        return True
+
+
+    def _on_frame_started(self) -> None:
+        start = time.perf_counter()
+        if not self._is_capture_due(start):
+            return
+        try:
+            slot = self.free_slots.get_nowait()
+        except queue.Empty:
+            self.dropped += 1
+            return
+        self.target_slot = slot
+        self.game.screen = slot
+        self.timestamps.append(start)
+        self.capture_time += time.perf_counter() - start
+
+
+    def _on_frame_ended(self, frame_time: float) -> None:
+        self.total_frame_time += frame_time
+        self.frame_count += 1
+        start = time.perf_counter()
+        if self.direct:
+            if self.target_slot is not None:
+                self.game.screen = self.display_surface
+                self.pending.put(self.target_slot)
+                self.target_slot = None
+                self.captured += 1
+                self.capture_time += time.perf_counter() - start
+            return
+
+        if not self._is_capture_due(start):
+            return
+
+        try:
+            slot = self.free_slots.get_nowait()
+        except queue.Empty:
+            # 写线程跟不上时丢帧, 不阻塞模拟
+            self.dropped += 1
+            return
+        if slot.get_size() == self.game.screen.get_size():
+            slot.blit(self.game.screen, (0, 0))
+        else:
+            pygame.transform.scale(self.game.screen, self.size, slot)
+        self.pending.put(slot)
+        self.timestamps.append(start)
+        self.captured += 1
+        self.capture_time += time.perf_counter() - start
+
+
+    def _write_loop(self) -> None:
+        while True:
+            slot = self.pending.get()
+            if slot is None:
+                return
+            view = slot.get_view("0")
+            self.file.write(view)
+            self.bytes_written += view.length
+            del view
+            self.free_slots.put(slot)
+
+
+    def close(self) -> None:
+        if self.direct:
+            self.game.frame_started_signal.disconnect(self._on_frame_started)
+            if self.target_slot is not None:
+                self.game.screen = self.display_surface
+                self.free_slots.put(self.target_slot)
+                self.timestamps.pop()
+                self.target_slot = None
+        self.game.frame_ended_signal.disconnect(self._on_frame_ended)
+        self.pending.put(None)
+        self.thread.join()
+        self.file.close()
+
+        fps = self.get_actual_fps()
+        self._write_sidecar(fps)
+        logger.info("capture: convert with: ffmpeg -f rawvideo -pix_fmt %s -s %dx%d -r %.3f -i %s out.mp4",
+                    self.pixel_format, *self.size, fps, self.path)
+
+        # 主线程上的额外开销, 分别相对模拟实际耗时和目标帧预算
+        captured = max(1, self.captured)
+        overhead = self.capture_time * 1000 / self.total_frame_time * 100 if self.total_frame_time > 0 else 0
+        budget = self.capture_time * 1000 / (self.frame_count * 1000.0 / self.game.fps) * 100 if self.game.fps > 0 and self.frame_count > 0 else 0
+        logger.info("capture: frames %d, dropped %d, %.1fMiB written, avg main-thread cost %.1fus/frame, %.1f%% of simulation time, %.1f%% of frame budget",
+                    self.captured, self.dropped, self.bytes_written / 1024 / 1024, self.capture_time * 1e6 / captured, overhead, budget)
+
+
+
+def run_net_loopback(game: Game, seconds: float, snapshot_rate: int) -> bool:
+    # 在同一进程内通过本机 TCP 连接服务端和解码端, 逐帧核对解码结果与服务端快照是否一致
+    server = SnapshotServer(game, "127.0.0.1", 0, snapshot_rate, remote_control=False)
+    connection = NetConnection(socket.create_connection(server.address[:2]))
+    codec = SnapshotCodec()
+    result = {"snapshots": 0, "mismatches": 0, "bytes": 0, "decode_time": 0.0}
+
+    def _on_frame_ended(frame_time: float) -> None:
+        for message in connection.receive_messages():
+            start = time.perf_counter()
+            tick, _, header, entities = codec.decode(message)
+            result["decode_time"] += time.perf_counter() - start
+            result["snapshots"] += 1
+            result["bytes"] += len(message)
+            if server.last_snapshot is not None and server.last_snapshot[0] == tick:
+                if (header, entities) != server.last_snapshot[1:]:
+                    result["mismatches"] += 1
+                    logger.error("net: loopback mismatch at tick %d", tick)
+    game.frame_ended_signal.connect(_on_frame_ended)
+
+    game.duration = pygame.time.get_ticks() + int(seconds * 1000)
+    game.run()
+    connection.close()
+    server.close()
+
+    snapshots = max(1, result["snapshots"])
+    logger.info("net: loopback snapshots %d, mismatches %d, avg %.1fB/snapshot, avg deserialise %.1fus/snapshot",
+                result["snapshots"], result["mismatches"], result["bytes"] / snapshots, result["decode_time"] * 1e6 / snapshots)
+    return result["snapshots"] > 0 and result["mismatches"] == 0
+
+
+def parse_address(address: str) -> tuple:
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="simple roguelike game")
+    parser.add_argument("--bot", action="store_true", help="由机器人代替玩家操作")
+    parser.add_argument("--headless", action="store_true", help="不创建窗口运行")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="使用 asyncio 版本的游戏循环")
+    parser.add_argument("--async-spin", type=float, default=0, metavar="MS", help="asyncio 循环每帧最后忙等的毫秒数, 帧时间更准但更耗 CPU, 默认 0 (不忙等)")
+    parser.add_argument("--fps", type=int, default=120, help="目标帧率, 必须大于 0")
+    parser.add_argument("--duration", type=float, default=0, help="运行指定秒数后退出, 0 表示不限制")
+    parser.add_argument("--memory-report", action="store_true", help="开启 tracemalloc, 退出时输出内存报告 (随时可按 F9 输出)")
+    parser.add_argument("--render-scale", type=float, default=1.0, help="世界的内部渲染分辨率相对窗口的比例, 例如 0.5")
+    parser.add_argument("--smooth-scaling", action="store_true", help="放大时使用平滑缩放, 默认使用最近邻")
+    parser.add_argument("--scale-ui", action="store_true", help="界面也画在低分辨率缓冲区上, 默认界面以窗口分辨率绘制")
+    parser.add_argument("--capture", metavar="PATH", help="把每一帧画面写入原始视频文件 (rawvideo), 同时生成 PATH.json 记录尺寸和像素格式")
+    parser.add_argument("--capture-fps", type=float, default=60, help="录制的帧率, 按实际经过的时间取帧, 必须大于 0")
+    parser.add_argument("--capture-scale", type=float, default=1.0, help="录制时的缩放比例")
+    parser.add_argument("--capture-pool", type=int, default=8, help="录制使用的帧缓冲数量, 写入跟不上时丢帧, 必须大于 0")
+    parser.add_argument("--server", metavar="HOST:PORT", help="以无窗口的服务端模式运行, 向客户端发送状态快照")
+    parser.add_argument("--client", metavar="HOST:PORT", help="以客户端模式运行, 只渲染服务端发来的状态")
+    parser.add_argument("--snapshot-rate", type=int, default=30, help="服务端每秒发送的快照数")
+    parser.add_argument("--net-loopback", type=float, metavar="SECONDS", help="在本机回环上运行服务端和解码端并校验快照")
+    parser.add_argument("--stats-interval", type=float, default=0, help="每隔指定秒数输出一次帧时间和节点数量, 0 表示不输出")
+    args = parser.parse_args()
+    if args.fps <= 0:
+        parser.error("--fps 必须大于 0")
+    if args.render_scale <= 0:
+        parser.error("--render-scale 必须大于 0")
+    if args.snapshot_rate <= 0:
+        parser.error("--snapshot-rate 必须大于 0")
+    if args.capture_pool <= 0:
+        parser.error("--capture-pool 必须大于 0")
+    if args.capture_fps <= 0:
+        parser.error("--capture-fps 必须大于 0")
+
+    if args.client:
+        client = SnapshotClient(*parse_address(args.client), fps=args.fps)
+        client.duration = int(args.duration * 1000)
+        client.run()
+        return
+
+    if args.server or args.net_loopback:
+        args.headless = True
+
+    if args.headless:
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        pygame.display.quit()
+        pygame.display.init()
+
+    game = Game()
+    game.fps = args.fps
+    game.async_spin_time = max(0.0, args.async_spin / 1000)
+    game.root.governor.target_fps = args.fps
+    game.duration = int(args.duration * 1000)
+    game.stats_interval = int(args.stats_interval * 1000)
+    game.smooth_scaling = args.smooth_scaling
+    game.ui_native = not args.scale_ui
+    game.set_render_scale(args.render_scale)
+    if args.bot:
+        game.root.get_first_node_in_group("player").controller = BotController()
+    if args.memory_report:
+        game.memory.start_tracing()
+    if args.net_loopback:
+        game.render_enabled = False
+        game.root.get_first_node_in_group("player").controller = BotController()
+        if not run_net_loopback(game, args.net_loopback, args.snapshot_rate):
+            raise SystemExit(1)
+        return
+    server = None
+    if args.server:
+        game.render_enabled = False
+        server = SnapshotServer(game, *parse_address(args.server), args.snapshot_rate, remote_control=not args.bot)
+    recorder = None
+    if args.capture:
+        recorder = FrameRecorder(game, args.capture, args.capture_fps, args.capture_scale, args.capture_pool, direct=args.headless)
+    if args.use_async:
+        asyncio.run(game.run_async())
+    else:
+        game.run()
+    if recorder is not None:
+        recorder.close()
+    if server is not None:
+        server.close()
+    if args.memory_report:
+        game.memory.dump()
+
+
+if __name__ == "__main__":
+    main()
 